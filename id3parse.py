@@ -1,5 +1,24 @@
+import os
 import re
+import sys
+import json
+import time
+import hashlib
+import select
+import struct
+import argparse
+import tempfile
 import math
+import zlib
+import bisect
+import functools
+import threading
+import ctypes
+import ctypes.util
+import concurrent.futures
+
+from array import array
+from collections import OrderedDict, deque, namedtuple
 
 def pack_int(integer, base, min_bytes=1):
 	if integer == 0:
@@ -69,52 +88,280 @@ def decode_text_encoding(e):
 	except KeyError:
 		raise ID3IllegalFormatError('Unknown text encoding "0x%02x"' % e)
 
+# A 0xff followed by a byte which could be mistaken for an MPEG sync or an unsynchronisation.
+FALSE_SYNC_PATTERN = re.compile(b'\xff(?=[\x00\xe1-\xff])')
+
 def unsync(byte_array):
-	def is_false_sync(current_byte, next_byte):
-		return current_byte == 0xff and (next_byte == 0x00 or next_byte > 0xe0)
+	return FALSE_SYNC_PATTERN.sub(b'\xff\x00', byte_array)
+
+def deunsync(byte_array):
+	return byte_array.replace(b'\xff\x00', b'\xff')
 
-	unsynced_byte_array = bytearray()
+def find_changed_ranges(old_byte_array, new_byte_array, block_size=4096, old_offset=0):
+	# Compares whole blocks first, which is done by memcmp, and narrows down only the blocks which differ.
+	# new_byte_array is compared against old_byte_array[old_offset:], without slicing old_byte_array.
+	start = None
 
-	for i in range(len(byte_array)):
-		current_byte = byte_array[i]
-		unsynced_byte_array.append(current_byte)
+	for offset in range(0, len(new_byte_array), block_size):
+		end = offset + block_size
+		if old_byte_array[old_offset + offset:old_offset + end] != new_byte_array[offset:end]:
+			if start is None:
+				start = offset
+		elif start is not None:
+			yield narrow_changed_range(old_byte_array, new_byte_array, start, offset, old_offset)
+			start = None
 
-		if i + 1 < len(byte_array):
-			next_byte = byte_array[i+1]
-			if is_false_sync(current_byte, next_byte):
-				unsynced_byte_array.append(0x00)
+	if start is not None:
+		yield narrow_changed_range(old_byte_array, new_byte_array, start, len(new_byte_array), old_offset)
 
-	return unsynced_byte_array
+def narrow_changed_range(old_byte_array, new_byte_array, start, end, old_offset=0):
+	old_end = min(end, len(old_byte_array) - old_offset)
 
-def deunsync(byte_array):
-	return byte_array.replace(b'\xff\x00', b'\xff')
+	while start < old_end and old_byte_array[old_offset + start] == new_byte_array[start]:
+		start += 1
 
-def extract_terminated_string(byte_array, terminator):
-	def find_indexes(byte_array, terminator):
-		start = 0
-		while True:
-			terminator_index = byte_array.index(terminator, start)
-			yield terminator_index
+	while end > start and end <= old_end and old_byte_array[old_offset + end - 1] == new_byte_array[end - 1]:
+		end -= 1
+
+	return start, end
+
+def write_at(f, offset, byte_array):
+	if not hasattr(os, 'pwrite'):
+		f.seek(offset)
+		f.write(byte_array)
+		return
+
+	f.flush()
+
+	view = memoryview(byte_array)
+	while len(view) > 0:
+		written = os.pwrite(f.fileno(), view, offset)
+		view = view[written:]
+		offset += written
+
+def write_buffers_at(f, offset, buffers):
+	# Buffers may be byte arrays or ID3PictureSource objects, which are streamed chunk by chunk.
+	byte_arrays = []
+
+	for byte_array in buffers:
+		if isinstance(byte_array, ID3PictureSource):
+			offset = write_byte_arrays_at(f, offset, byte_arrays)
+			byte_arrays = []
+
+			for chunk in byte_array.iter_chunks():
+				write_at(f, offset, chunk)
+				offset += len(chunk)
+		else:
+			byte_arrays.append(byte_array)
+
+	return write_byte_arrays_at(f, offset, byte_arrays)
+
+def write_byte_arrays_at(f, offset, byte_arrays):
+	if not hasattr(os, 'pwritev'):
+		for byte_array in byte_arrays:
+			write_at(f, offset, byte_array)
+			offset += len(byte_array)
+		return offset
+
+	f.flush()
+
+	views = [memoryview(b) for b in byte_arrays if len(b) > 0]
+	first = 0
+
+	while first < len(views):
+		written = os.pwritev(f.fileno(), views[first:first + IOV_MAX], offset)
+		offset += written
+
+		while first < len(views) and written >= len(views[first]):
+			written -= len(views[first])
+			first += 1
+
+		if written > 0:
+			views[first] = views[first][written:]
+
+	return offset
+
+def read_at(f, offset, n):
+	f.seek(offset)
+	return f.read(n)
+
+def read_exactly(stream, n):
+	# Pipes may return fewer bytes than asked for, so reads are repeated until n bytes or the end of the stream.
+	chunks = []
+
+	while n > 0:
+		chunk = stream.read(n)
+		if not chunk:
+			break
+
+		chunks.append(chunk)
+		n -= len(chunk)
+
+	return b''.join(chunks)
+
+def skip_stream(stream, n, chunk_size=64 * 1024):
+	while n > 0:
+		chunk = stream.read(min(n, chunk_size))
+		if not chunk:
+			break
+
+		n -= len(chunk)
+
+def move_file_range(f, source, destination, length, chunk_size=1024 * 1024):
+	# Moves length bytes within the file chunk by chunk, so the content never has to fit into memory. The ranges
+	# may overlap.
+	chunk_spans = [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
 
-			start = terminator_index + 1
+	# Moving towards the end of the file has to start at the end, so no byte is overwritten before it is moved.
+	if destination > source:
+		chunk_spans.reverse()
 
-	for terminator_index in find_indexes(byte_array, terminator):
-		if terminator_index % len(terminator) == 0:
-			return byte_array[0:terminator_index]
+	for start, end in chunk_spans:
+		write_at(f, destination + start, read_at(f, source + start, end - start))
+
+def copy_file_range(source, source_offset, destination, destination_offset, chunk_size=1024 * 1024):
+	# Copies everything from source_offset to the end of the source file, chunk by chunk.
+	while True:
+		chunk = read_at(source, source_offset, chunk_size)
+		if len(chunk) == 0:
+			break
+
+		write_at(destination, destination_offset, chunk)
+		source_offset += len(chunk)
+		destination_offset += len(chunk)
+
+def fsync_path(path):
+	# Works for files and directories alike.
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def load_libc():
+	if not sys.platform.startswith('linux'):
+		return None
+
+	try:
+		return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+	except OSError:
+		return None
+
+def join_buffers(buffers):
+	return b''.join(b.read() if isinstance(b, ID3PictureSource) else b for b in buffers)
+
+def iter_buffer_segments(buffers, segment_size=64 * 1024):
+	# Yields the content of the buffers in segments of about segment_size bytes. Small buffers are joined, big
+	# buffers are passed on as they are and ID3PictureSource objects are read chunk by chunk.
+	small_buffers = []
+	small_buffers_size = 0
+
+	for byte_array in buffers:
+		if not isinstance(byte_array, ID3PictureSource) and len(byte_array) < segment_size:
+			small_buffers.append(byte_array)
+			small_buffers_size += len(byte_array)
+
+			if small_buffers_size >= segment_size:
+				yield b''.join(small_buffers)
+				small_buffers = []
+				small_buffers_size = 0
+
+			continue
+
+		if len(small_buffers) > 0:
+			yield b''.join(small_buffers)
+			small_buffers = []
+			small_buffers_size = 0
+
+		if isinstance(byte_array, ID3PictureSource):
+			for chunk in byte_array.iter_chunks(segment_size):
+				yield chunk
+		else:
+			yield byte_array
+
+	if len(small_buffers) > 0:
+		yield b''.join(small_buffers)
+
+# A terminator has to be aligned to its own length, relative to the start of the string. bytes.find skips most of
+# the string at memchr speed, and a misaligned hit is retried one byte further. Memoryviews have no find, and strings
+# with many misaligned hits, e.g. UTF-16 text full of U+0100, fall back to the lazy repetition of whole code units,
+# which finds the first aligned terminator in a single linear pass.
+TERMINATOR_PATTERNS = {
+	b'\x00': re.compile(b'\x00'),
+	b'\x00\x00': re.compile(b'(?:..)*?\x00\x00', re.DOTALL)
+}
+
+MAX_MISALIGNED_TERMINATORS = 32
+
+def get_terminator_pattern(terminator):
+	if terminator in TERMINATOR_PATTERNS:
+		return TERMINATOR_PATTERNS[terminator]
+
+	return re.compile(b'(?:' + b'.' * len(terminator) + b')*?' + re.escape(terminator), re.DOTALL)
+
+def find_terminated_string(byte_array, terminator, start=0, end=None):
+	# Returns the span of the string starting at start, without its terminator, or None if it is not terminated. Works
+	# on all objects supporting the buffer protocol, including memoryviews, and never slices byte_array.
+	if end is None:
+		end = len(byte_array)
+
+	position = start
+
+	if hasattr(byte_array, 'find'):
+		for _ in range(MAX_MISALIGNED_TERMINATORS):
+			index = byte_array.find(terminator, position, end)
+			if index == -1:
+				return None
+
+			if (index - start) % len(terminator) == 0:
+				return start, index
+
+			position = index + 1
+
+		# The next code unit boundary at or after position.
+		position += -(position - start) % len(terminator)
+
+	pattern = get_terminator_pattern(terminator)
+
+	if len(terminator) == 1:
+		match = pattern.search(byte_array, position, end)
+		if match is None:
+			return None
+
+		return start, match.start()
+
+	match = pattern.match(byte_array, position, end)
+	if match is None:
+		return None
+
+	return start, match.end() - len(terminator)
+
+def extract_terminated_string(byte_array, terminator, start=0):
+	span = find_terminated_string(byte_array, terminator, start)
+	if span is None:
+		raise ValueError('String starting at %d is not terminated' % start)
+
+	return byte_array[span[0]:span[1]]
 
 
 class ByteReader:
 
-	def __init__(self, byte_array):
+	# Reads from byte_array[position:end]. Skipping and cloning only move positions, so no bytes are copied until
+	# they are actually read.
+
+	def __init__(self, byte_array, position=0, end=None):
 		self.byte_array = byte_array
+		self.position = position
+		self.end = len(byte_array) if end is None else min(end, len(byte_array))
 
 	def peek(self, n=None):
-		bts = self.byte_array[0:n or 1]
-
 		if n is None:
-			return bts[0]
-		else:
-			return bts
+			if self.position >= self.end:
+				raise IndexError('No bytes left')
+
+			return self.byte_array[self.position]
+
+		return self.byte_array[self.position:min(self.position + n, self.end)]
 
 	def read(self, n=None):
 		bts = self.peek(n)
@@ -123,19 +370,22 @@ class ByteReader:
 		return bts
 
 	def skip(self, n):
-		self.byte_array = self.byte_array[n:]
+		self.position = min(self.position + n, self.end)
 
 	def tail(self):
-		return self.byte_array
+		return self.byte_array[self.position:self.end]
 
 	def clone(self, n=None):
 		if n is None:
-			return ByteReader(self.tail())
-		else:
-			return ByteReader(self.read(n))
+			return ByteReader(self.byte_array, self.position, self.end)
+
+		clone = ByteReader(self.byte_array, self.position, min(self.position + n, self.end))
+		self.skip(n)
+
+		return clone
 
 	def bytes_left(self):
-		return len(self.byte_array)
+		return self.end - self.position
 
 
 TAG_HEADER_SIZE = 10
@@ -146,6 +396,255 @@ SUPPORTED_MAJOR_VERSION = 4
 SYNCHSAFE_BASE = 128
 DEFAULT_BASE = 256
 
+READ_AHEAD_SIZE = 64 * 1024
+
+try:
+	IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	IOV_MAX = 1024
+
+
+def read_tag_buffer(input_stream, limits=None, read_ahead=READ_AHEAD_SIZE):
+	# Returns a buffer which starts with the tag, and the length of the tag. The first read speculatively asks for
+	# read_ahead bytes, which usually covers the whole tag, so the buffer may extend past the tag. The stream is left
+	# right after the tag. Streams which cannot seek back are never read past the tag.
+	seekable = hasattr(input_stream, 'seekable') and input_stream.seekable()
+	if not seekable:
+		read_ahead = TAG_HEADER_SIZE
+
+	buffer = input_stream.read(max(read_ahead, TAG_HEADER_SIZE))
+
+	try:
+		header = ID3Header.from_byte_array(buffer[0:TAG_HEADER_SIZE])
+	except ID3IllegalFormatError:
+		if seekable:
+			input_stream.seek(-len(buffer), os.SEEK_CUR)
+		raise
+
+	# The tag size is checked before the tag is read, because it determines how much memory is allocated.
+	if limits is not None:
+		limits.check('max_tag_size', header.tag_size)
+
+	tag_length = TAG_HEADER_SIZE + header.tag_size
+	if header.flags.has_footer:
+		tag_length += FOOTER_SIZE
+
+	if len(buffer) < tag_length:
+		# Only tags bigger than the read-ahead need a second read, which asks for precisely the missing bytes.
+		buffer += input_stream.read(tag_length - len(buffer))
+	elif len(buffer) > tag_length:
+		input_stream.seek(tag_length - len(buffer), os.SEEK_CUR)
+
+	return buffer, tag_length
+
+def read_tag_bytes(input_stream, limits=None, read_ahead=READ_AHEAD_SIZE):
+	buffer, tag_length = read_tag_buffer(input_stream, limits, read_ahead)
+
+	return buffer if len(buffer) <= tag_length else buffer[0:tag_length]
+
+def get_frame_region(byte_array, header):
+	# Returns the span of the frames and the padding, between the (extended) header and the footer.
+	start = TAG_HEADER_SIZE
+	end = TAG_HEADER_SIZE + header.tag_size
+
+	if header.flags.has_extended_header:
+		start += ID3ExtendedHeader.unpack_size(byte_array[start:start + 4], header.major_version)
+
+	return start, min(end, len(byte_array))
+
+
+ID3FrameSpan = namedtuple('ID3FrameSpan', ('name', 'start', 'body_start', 'body_end', 'format_flags'))
+
+def iter_frame_spans(byte_array, tag_version, start=0, end=None):
+	# Walks the frame headers only, without reading any frame body or creating any ID3Frame.
+	if end is None:
+		end = len(byte_array)
+
+	position = start
+
+	while position < end and byte_array[position] != 0:
+		if position + FRAME_HEADER_SIZE > end:
+			raise ID3IllegalFormatError('Frame header at %d exceeds the tag' % position)
+
+		frame_span = parse_frame_span(byte_array[position:position + FRAME_HEADER_SIZE], position, tag_version)
+
+		yield frame_span
+		position = frame_span.body_end
+
+def parse_frame_span(frame_header, position, tag_version):
+	try:
+		name = frame_header[0:4].decode('ascii')
+	except UnicodeDecodeError:
+		raise ID3IllegalFormatError('Illegal frame name at %d' % position)
+
+	base = SYNCHSAFE_BASE if tag_version == 4 else DEFAULT_BASE
+	body_size = unpack_int(frame_header[4:8], base=base)
+	format_flags = ID3FrameFormatFlags.from_byte(frame_header[9])
+
+	body_start = position + FRAME_HEADER_SIZE
+	if format_flags.has_grouping_id:
+		body_start += 1
+	if format_flags.has_data_length_indicator:
+		body_start += 4
+
+	body_end = position + FRAME_HEADER_SIZE + body_size
+
+	return ID3FrameSpan(name, position, body_start, body_end, format_flags)
+
+def read_frame_body(f, frame_span):
+	body_bytes = read_at(f, frame_span.body_start, frame_span.body_end - frame_span.body_start)
+	if frame_span.format_flags.unsynced:
+		body_bytes = deunsync(body_bytes)
+
+	return body_bytes
+
+def read_tag_header(input_stream):
+	# Reads the header and the extended header of the tag at the start of input_stream. Returns the header and the
+	# span of the frames and the padding within the file.
+	header = ID3Header.from_byte_array(input_stream.read(TAG_HEADER_SIZE))
+
+	start = TAG_HEADER_SIZE
+	if header.flags.has_extended_header:
+		start += read_extended_header(input_stream, header.major_version).size
+
+	return header, start, TAG_HEADER_SIZE + header.tag_size
+
+def read_extended_header(input_stream, tag_version):
+	size_bytes = input_stream.read(4)
+	size = ID3ExtendedHeader.unpack_size(size_bytes, tag_version)
+
+	return ID3ExtendedHeader.from_byte_array(size_bytes + input_stream.read(size - len(size_bytes)), tag_version)
+
+def crc32_buffers(buffers):
+	crc = 0
+
+	for byte_array in buffers:
+		chunks = byte_array.iter_chunks() if isinstance(byte_array, ID3PictureSource) else (byte_array,)
+		for chunk in chunks:
+			crc = zlib.crc32(chunk, crc)
+
+	return crc
+
+def iter_file_frame_spans(f, tag_version, start, end):
+	# Like iter_frame_spans, but reads the frame headers from a seekable file and seeks over the frame bodies.
+	position = start
+
+	while position + FRAME_HEADER_SIZE <= end:
+		frame_header = read_at(f, position, FRAME_HEADER_SIZE)
+		if len(frame_header) < FRAME_HEADER_SIZE or frame_header[0] == 0:
+			return
+
+		frame_span = parse_frame_span(frame_header, position, tag_version)
+
+		yield frame_span
+		position = frame_span.body_end
+
+FRAME_NAME_PATTERN = re.compile(b'[A-Z][A-Z0-9]{3}')
+
+def get_plausible_frame_end(byte_array, position, end, tag_version):
+	# Returns where the frame at position ends if its header looks valid, or None.
+	if position + FRAME_HEADER_SIZE > end or FRAME_NAME_PATTERN.match(byte_array, position) is None:
+		return None
+
+	body_size_bytes = byte_array[position + 4:position + 8]
+	if tag_version == 4 and any(b & 0x80 for b in body_size_bytes):
+		return None
+
+	frame_end = position + FRAME_HEADER_SIZE + unpack_int(body_size_bytes, base=SYNCHSAFE_BASE if tag_version == 4 else DEFAULT_BASE)
+	return frame_end if frame_end <= end else None
+
+def find_plausible_frame_header(byte_array, start, end, tag_version):
+	# Returns the position of the next plausible frame header, or end. Every search continues after the previous
+	# candidate, so the bytes are scanned once.
+	match = FRAME_NAME_PATTERN.search(byte_array, start, end)
+
+	while match is not None:
+		if get_plausible_frame_end(byte_array, match.start(), end, tag_version) is not None:
+			return match.start()
+
+		match = FRAME_NAME_PATTERN.search(byte_array, match.start() + 1, end)
+
+	return end
+
+def get_damage_end(byte_array, start, end):
+	# Padding after the last damaged frame does not count as damaged.
+	while end > start + 1 and byte_array[end - 1] == 0:
+		end -= 1
+
+	return end
+
+def get_frame_body(byte_array, frame_span):
+	body_bytes = byte_array[frame_span.body_start:frame_span.body_end]
+	if frame_span.format_flags.unsynced:
+		body_bytes = deunsync(body_bytes)
+
+	return body_bytes
+
+
+class ID3StringPool:
+
+	# Decoded text frame values, shared between all tags parsed with the same pool. A value which occurs many times in
+	# a library, e.g. an artist or a genre, is decoded once and all frames holding it share the same string objects.
+
+	def __init__(self, max_entries=65536):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+
+	def decode(self, key, decode_body):
+		# key is (tag_version, body of the text frame), the body starts with the encoding byte.
+		with self.lock:
+			texts = self.entries.get(key)
+			if texts is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				self.bytes_saved += sum(sys.getsizeof(t) for t in texts)
+				return list(texts)
+
+		texts = tuple(decode_body(key[1], key[0]))
+
+		with self.lock:
+			self.misses += 1
+			self.entries[key] = texts
+
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+		return list(texts)
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0.0
+
+		return self.hits / lookups
+
+	def __len__(self):
+		return len(self.entries)
+
+
+class ID3Limits:
+
+	# Limits for parsing tags from untrusted sources. Every limit is checked before the memory it guards is
+	# allocated, a limit of None is not enforced.
+
+	def __init__(self, max_tag_size=None, max_frames=None, max_frame_size=None, max_decompressed_size=None):
+		self.max_tag_size = max_tag_size
+		self.max_frames = max_frames
+		self.max_frame_size = max_frame_size
+		self.max_decompressed_size = max_decompressed_size
+
+	def check(self, name, value):
+		limit = getattr(self, name)
+
+		if limit is not None and value > limit:
+			raise ID3LimitExceededError('%s exceeded: %d > %d' % (name, value, limit))
+
 
 class ID3PictureTypes:
 	OTHER = 0x00
@@ -173,45 +672,71 @@ class ID3PictureTypes:
 
 class ID3:
 
-	def from_byte_array(byte_array):
+	def from_byte_array(byte_array, string_pool=None, limits=None, salvage=False):
 		br = ByteReader(byte_array)
 
 		header = ID3Header.from_byte_reader(br.clone(TAG_HEADER_SIZE))
 		body_size = header.tag_size
 
+		if limits is not None:
+			limits.check('max_tag_size', header.tag_size)
+
 		extended_header = None
 		if header.flags.has_extended_header:
-			extended_header = ID3ExtendedHeader.from_byte_reader(br.clone())
+			extended_header = ID3ExtendedHeader.from_byte_reader(br.clone(), header.major_version)
 			br.skip(extended_header.size)
 			body_size -= extended_header.size
 
-		body = ID3Body.from_byte_reader(br.clone(body_size), tag_version=header.major_version)
-		return ID3(header, body)
+		body = ID3Body.from_byte_reader(
+			br.clone(body_size), tag_version=header.major_version, string_pool=string_pool, limits=limits, salvage=salvage
+		)
+		return ID3(header, body, extended_header)
 
-	def from_input_stream(input_stream):
-		total_bytes = input_stream.read(TAG_HEADER_SIZE)
-		header = ID3Header.from_byte_array(total_bytes)
+	def from_input_stream(input_stream, string_pool=None, limits=None, read_ahead=READ_AHEAD_SIZE, salvage=False):
+		# The tag is parsed straight from the read buffer, which may extend past the tag.
+		buffer, _ = read_tag_buffer(input_stream, limits, read_ahead)
+		return ID3.from_byte_array(buffer, string_pool=string_pool, limits=limits, salvage=salvage)
 
-		# ID3 body
-		total_bytes += input_stream.read(header.tag_size)
+	def from_file(path, string_pool=None, limits=None, read_ahead=READ_AHEAD_SIZE, salvage=False):
+		with open(path, 'rb') as file:
+			try:
+				id3 = ID3.from_input_stream(file, string_pool=string_pool, limits=limits, read_ahead=read_ahead, salvage=salvage)
+			except ID3IllegalFormatError:
+				id3 = ID3.from_scratch()
 
-		if header.flags.has_footer:
-			total_bytes += input_stream.read(FOOTER_SIZE)
+		id3.initial_path = path
 
-		return ID3.from_byte_array(total_bytes)
+		return id3
 
-	def from_file(path):
-		file = open(path, 'rb')
+	def fingerprint(path, read_ahead=READ_AHEAD_SIZE):
+		# Returns a hash of the frames of the tag in the file, or None if the file has no tag or its header cannot be
+		# read, e.g. because of an unsupported version. Only the frame headers are walked to find the end of the last
+		# frame, so padding and the extended header do not change the hash. If the frame headers are damaged, the
+		# whole frame region including the padding is hashed instead.
+		with open(path, 'rb') as f:
+			try:
+				byte_array, _ = read_tag_buffer(f, read_ahead=read_ahead)
+			except ID3Error:
+				return None
+
+		header = ID3Header.from_byte_array(byte_array[0:TAG_HEADER_SIZE])
 
 		try:
-			id3 = ID3.from_input_stream(file)
-		except ID3IllegalFormatError:
-			id3 = ID3.from_scratch()
+			start, end = get_frame_region(byte_array, header)
+		except ID3Error:
+			start, end = TAG_HEADER_SIZE, min(TAG_HEADER_SIZE + header.tag_size, len(byte_array))
 
-		id3.initial_path = path
+		frames_end = start
+		try:
+			for frame_span in iter_frame_spans(byte_array, header.major_version, start, end):
+				frames_end = min(frame_span.body_end, end)
+		except ID3Error:
+			frames_end = end
 
-		file.close()
-		return id3
+		fingerprint = hashlib.blake2b(bytes([header.major_version]), digest_size=16)
+		fingerprint.update(memoryview(byte_array)[start:frames_end])
+
+		return fingerprint.hexdigest()
 
 	def from_scratch():
 		header = ID3Header.from_scratch()
@@ -219,14 +744,75 @@ class ID3:
 
 		return ID3(header, body)
 
-	def __init__(self, header, body):
+	def from_pickled_bytes(byte_array, extended_header, damaged_ranges, initial_path):
+		# The tag is parsed on first access to its header or body.
+		id3 = ID3.__new__(ID3)
+		id3._pickled_state = (byte_array, extended_header, damaged_ranges)
+		id3._pickled_state_lock = threading.Lock()
+
+		if initial_path is not None:
+			id3.initial_path = initial_path
+
+		return id3
+
+	def __init__(self, header, body, extended_header=None):
 		self.header = header
 		self.body = body
+		self.extended_header = extended_header
+
+	def __getattr__(self, name):
+		if name in ('header', 'body', 'extended_header') and '_pickled_state_lock' in self.__dict__:
+			# Threads which touch a freshly unpickled tag at the same time wait for the first one to parse it.
+			with self._pickled_state_lock:
+				state = self.__dict__.pop('_pickled_state', None)
+
+				if state is not None:
+					byte_array, extended_header, damaged_ranges = state
+
+					header = ID3Header.from_byte_array(byte_array[0:TAG_HEADER_SIZE])
+					body = ID3Body.from_byte_reader(ByteReader(byte_array, TAG_HEADER_SIZE), header.major_version)
+					body.damaged_ranges = damaged_ranges
+
+					self.header = header
+					self.body = body
+					self.extended_header = extended_header
+
+			if name in self.__dict__:
+				return self.__dict__[name]
+
+		raise AttributeError(name)
+
+	def __reduce__(self):
+		# Pickles the header and the frames as bytes instead of the object graph. Frames which have not been modified
+		# are not encoded again, so this is mostly copying bytes.
+		state = self.__dict__.get('_pickled_state')
+		if state is None:
+			state = (self.get_pickled_bytes(), self.extended_header, self.damaged_ranges)
+
+		return (ID3.from_pickled_bytes, state + (getattr(self, 'initial_path', None),))
+
+	def get_pickled_bytes(self):
+		# Unlike serialize, this keeps the version the tag was read with and does not update the sizes in the headers,
+		# so pickling does not change the tag. All frames are encoded for the version of the tag, because they are
+		# parsed with it. The extended header is pickled separately.
+		header = self.header
+		header_bytes = (
+			b'ID3' + bytes([header.major_version, 0]) + header.flags.serialize()
+			+ pack_int(header.tag_size, base=SYNCHSAFE_BASE, min_bytes=4)
+		)
+
+		return join_buffers([header_bytes] + [f.get_pickled_bytes(header.major_version) for f in self.frames])
 
 	@property
 	def frames(self):
 		return self.body.frames
 
+	@property
+	def damaged_ranges(self):
+		# Spans of the tag which were skipped when parsing in salvage mode, as (start, end) offsets from the start of
+		# the tag.
+		return self.body.damaged_ranges
+
 	def find_frame_by_name(self, name):
 		return self.body.find_frame_by_name(name)
 
@@ -237,57 +823,395 @@ class ID3:
 		self.body.add_frame(frame)
 
 	def serialize(self, min_length=0):
+		return join_buffers(self.serialize_buffers(min_length))
+
+	def serialized_size(self, min_length=0):
+		# The length of serialize(min_length), computed from the sizes of the frames without joining any bytes.
+		size = TAG_HEADER_SIZE + self.body.serialized_size()
+
 		if self.header.flags.has_extended_header:
-			raise ID3UnsupportedFeatureError('Extended header not supported during serialization.')
+			size += len((self.extended_header or ID3ExtendedHeader.from_scratch()).serialize())
+
+		size = max(size, min_length)
+
+		if self.header.flags.has_footer:
+			size += FOOTER_SIZE
+
+		return size
 
-		body_bytes = self.body.serialize()
+	def serialize_buffers(self, min_length=0):
+		# The returned buffers are not copied into one byte array, so large frame bodies, e.g. pictures, can be
+		# written to a file without being copied.
+		body_buffers = self.body.serialize_buffers()
+		body_size = sum(len(b) for b in body_buffers)
 
 		min_length -= TAG_HEADER_SIZE
-		if len(body_bytes) < min_length:
-			body_bytes += b'\x00' * (min_length - len(body_bytes))
 
-		self.header.tag_size = len(body_bytes)
+		extended_header = None
+		if self.header.flags.has_extended_header:
+			if self.extended_header is None:
+				self.extended_header = ID3ExtendedHeader.from_scratch()
+
+			# The size of the extended header does not depend on the CRC, so it is known before the CRC.
+			extended_header = self.extended_header
+			min_length -= len(extended_header.serialize())
+
+		if body_size < min_length:
+			body_buffers.append(b'\x00' * (min_length - body_size))
+			body_size = min_length
 
-		footer_bytes = b''
+		if extended_header is not None:
+			# The CRC covers the frames and the padding.
+			if extended_header.has_crc:
+				extended_header.crc = crc32_buffers(body_buffers)
+
+			extended_header_bytes = extended_header.serialize()
+			body_buffers.insert(0, extended_header_bytes)
+			body_size += len(extended_header_bytes)
+
+		self.header.tag_size = body_size
+
+		footer_buffers = []
 		if self.header.flags.has_footer:
-			footer_bytes = self.header.serialize_footer()
+			footer_buffers.append(self.header.serialize_footer())
 
 		header_bytes = self.header.serialize_header()
 
-		return header_bytes + body_bytes + footer_bytes
+		return [header_bytes] + body_buffers + footer_buffers
 
-	def to_file(self, path=None):
+	def to_file(self, path=None, atomic=False, max_padding=None):
+		# If atomic is set and the tag does not fit into the file anymore, a new file is written and moved into place
+		# after it has been synced, so a crash leaves either the old or the new file. Tags which fit are always
+		# written in place. The padding of the existing tag is kept, unless max_padding is given and the tag would
+		# have more padding than that, in which case the tag shrinks and the audio is moved towards the start.
 		path = path or self.initial_path
 		if path is None:
 			raise ValueError('Path must be given if saving a tag which was not loaded from a file')
 
-		f = open(path, 'r+b')
+		temporary_path = self.write_to_file(path, atomic, max_padding)
+
+		if temporary_path is not None:
+			fsync_path(temporary_path)
+			os.replace(temporary_path, path)
+			fsync_path(os.path.dirname(os.path.abspath(path)))
 
+	def to_stream(self, output, audio_stream, chunk_size=64 * 1024):
+		# Writes the tag followed by the audio of audio_stream to output, e.g. from pipe to pipe. A tag at the start of
+		# audio_stream is skipped and replaced by this one. Neither stream has to be seekable and at most chunk_size
+		# bytes of audio are held in memory. Returns the number of bytes written.
+		written = 0
+
+		for segment in iter_buffer_segments(self.serialize_buffers(), chunk_size):
+			output.write(segment)
+			written += len(segment)
+
+		head = read_exactly(audio_stream, TAG_HEADER_SIZE)
+
+		try:
+			existing_header = ID3Header.from_byte_array(head)
+		except ID3Error:
+			existing_header = None
+
+		if existing_header is not None:
+			existing_tag_size = existing_header.tag_size
+			if existing_header.flags.has_footer:
+				existing_tag_size += FOOTER_SIZE
+
+			skip_stream(audio_stream, existing_tag_size, chunk_size)
+		else:
+			output.write(head)
+			written += len(head)
+
+		while True:
+			chunk = audio_stream.read(chunk_size)
+			if not chunk:
+				break
+
+			output.write(chunk)
+			written += len(chunk)
+
+		return written
+
+	def write_to_file(self, path, atomic=False, max_padding=None):
+		# Returns the path of the new file if atomic is set and the tag does not fit into the file anymore, or shrinks.
+		# It is up to the caller to sync it and move it into place.
+		# The file is not buffered, because it is written with os.pwrite.
+		with open(path, 'r+b', buffering=0) as f:
+			return self.write_to_open_file(f, path, atomic, max_padding)
+
+	def write_to_open_file(self, f, path, atomic, max_padding=None):
 		try:
 			existing_header = ID3Header.from_byte_array(f.read(TAG_HEADER_SIZE))
 			initial_tag_size = existing_header.tag_size + TAG_HEADER_SIZE
 		except ID3IllegalFormatError:
 			initial_tag_size = 0
 
-		serialized_tag = self.serialize(min_length=initial_tag_size)
-		current_tag_size = len(serialized_tag)
+		# Deciding between writing in place and moving the audio does not need the serialized tag.
+		min_length = initial_tag_size
+		if max_padding is not None:
+			min_length = min(initial_tag_size, self.serialized_size() + max_padding)
+
+		current_tag_size = self.serialized_size(min_length=min_length)
+		tag_buffers = self.serialize_buffers(min_length=min_length)
+
+		def write_changed_ranges():
+			# The existing tag is compared segment by segment, so it is never read into memory as a whole.
+			offset = 0
+			for segment in iter_buffer_segments(tag_buffers):
+				existing_segment = read_at(f, offset, len(segment))
+
+				for start, end in find_changed_ranges(existing_segment, segment):
+					write_at(f, offset + start, segment[start:end])
+
+				offset += len(segment)
+
+		def load_pictures_from_this_file(keep_unmoved=False):
+			# Pictures which are read from the file itself would be overwritten before they are read. A picture which
+			# stays at its offset is only ever compared with itself, so it can be kept if the tag is written in place.
+			offset = 0
+			for i, byte_array in enumerate(tag_buffers):
+				if isinstance(byte_array, ID3PictureSource) and byte_array.is_in_file(path):
+					if not (keep_unmoved and byte_array.offset == offset):
+						tag_buffers[i] = byte_array.read()
+
+				offset += len(byte_array)
+
+		def write_temporary_file():
+			directory, name = os.path.split(os.path.abspath(path))
+			temporary_file = tempfile.NamedTemporaryFile(dir=directory, prefix='.' + name + '.', delete=False)
+
+			try:
+				with temporary_file:
+					os.chmod(temporary_file.name, os.fstat(f.fileno()).st_mode & 0o7777)
+					copy_file_range(f, initial_tag_size, temporary_file, write_buffers_at(temporary_file, 0, tag_buffers))
+			except BaseException:
+				os.remove(temporary_file.name)
+				raise
+
+			return temporary_file.name
+
+		if current_tag_size <= initial_tag_size and min_length == initial_tag_size:
+			load_pictures_from_this_file(keep_unmoved=True)
+			write_changed_ranges()
+		elif atomic:
+			return write_temporary_file()
+		elif current_tag_size < initial_tag_size:
+			# The shorter tag ends before the audio, so it can be written first. Then the audio is moved towards the
+			# start and the rest of the file is cut off.
+			load_pictures_from_this_file()
+
+			file_size = os.fstat(f.fileno()).st_size
+			write_buffers_at(f, 0, tag_buffers)
+			move_file_range(f, initial_tag_size, current_tag_size, file_size - initial_tag_size)
+			f.truncate(file_size - initial_tag_size + current_tag_size)
+		else:
+			load_pictures_from_this_file()
+
+			audio_size = os.fstat(f.fileno()).st_size - initial_tag_size
+			move_file_range(f, initial_tag_size, current_tag_size, audio_size)
+			write_buffers_at(f, 0, tag_buffers)
+
+		return None
 
-		def write_tag():
-			f.seek(0)
-			f.write(serialized_tag)
 
-		def read_mp3():
-			f.seek(initial_tag_size)
-			return f.read()
+class ID3WriteSession:
 
-		if current_tag_size <= initial_tag_size:
-			write_tag()
+	# Writes many tags with ID3.to_file and makes them durable in batches instead of syncing every file. Tags which
+	# do not fit into their file anymore are written to a new file, which replaces the old one at the next barrier.
+	# Until then a crash leaves the old file. Use as a context manager, so the last batch is committed.
+
+	def __init__(self, batch_size=256, atomic=True, use_syncfs=True):
+		self.batch_size = batch_size
+		self.atomic = atomic
+
+		libc = load_libc() if use_syncfs else None
+		self.syncfs = libc.syncfs if hasattr(libc, 'syncfs') else None
+
+		self.written_paths = []
+		self.replacements = []
+		self.replaced_paths = set()
+
+		self.files = 0
+		self.batches = 0
+		self.timings = OrderedDict((phase, 0.0) for phase in ('write', 'sync', 'replace'))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exception_type, exception, traceback):
+		if exception_type is None:
+			self.commit()
+		else:
+			for temporary_path, _ in self.replacements:
+				os.remove(temporary_path)
+
+	def write(self, id3, path=None):
+		path = path or id3.initial_path
+		if path is None:
+			raise ValueError('Path must be given if saving a tag which was not loaded from a file')
+
+		# A pending replacement of the same file would replace this write at the barrier, so it is committed first.
+		if os.path.abspath(path) in self.replaced_paths:
+			self.commit()
+
+		start = time.perf_counter()
+		temporary_path = id3.write_to_file(path, self.atomic)
+		self.timings['write'] += time.perf_counter() - start
+
+		if temporary_path is None:
+			self.written_paths.append(path)
 		else:
-			mp3_content = read_mp3()
-			write_tag()
-			f.write(mp3_content)
+			self.replacements.append((temporary_path, path))
+			self.replaced_paths.add(os.path.abspath(path))
+
+		self.files += 1
+
+		if len(self.written_paths) + len(self.replacements) >= self.batch_size:
+			self.commit()
+
+	def commit(self):
+		# The durability barrier: syncs all files written since the last barrier, then moves the new files into
+		# place and syncs their directories.
+		if len(self.written_paths) + len(self.replacements) == 0:
+			return
+
+		start = time.perf_counter()
+		self.sync_files(self.written_paths + [t for t, _ in self.replacements])
+		self.timings['sync'] += time.perf_counter() - start
+
+		start = time.perf_counter()
+		directories = set()
+		for temporary_path, path in self.replacements:
+			os.replace(temporary_path, path)
+			directories.add(os.path.dirname(os.path.abspath(path)))
+
+		for directory in directories:
+			fsync_path(directory)
+		self.timings['replace'] += time.perf_counter() - start
+
+		self.written_paths = []
+		self.replacements = []
+		self.replaced_paths = set()
+		self.batches += 1
+
+	def sync_files(self, paths):
+		if self.syncfs is None:
+			for path in paths:
+				fsync_path(path)
+			return
+
+		# One syncfs per filesystem is cheaper than an fsync per file.
+		paths_by_device = {}
+		for path in paths:
+			paths_by_device.setdefault(os.stat(path).st_dev, path)
+
+		for path in paths_by_device.values():
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				if self.syncfs(fd) != 0:
+					error = ctypes.get_errno()
+					raise OSError(error, os.strerror(error), path)
+			finally:
+				os.close(fd)
+
+	def report(self):
+		timings = ', '.join('%s %.3fs' % (phase, duration) for phase, duration in self.timings.items())
+		return '%d files in %d batches: %s' % (self.files, self.batches, timings)
+
+
+class ID3Columns:
+
+	# Column oriented export of many tags. Only the frame headers are walked and only the bodies of the requested
+	# frames are decoded, no ID3 or ID3Frame objects are created.
+
+	def from_files(paths, frame_names, string_pool=None):
+		columns = ID3Columns(frame_names)
+
+		for path in paths:
+			columns.append_file(path, string_pool)
+
+		return columns
+
+	def read_file(path, frame_names, string_pool=None):
+		# Returns the header of the tag and the values of the first frame with each of the given names.
+		with open(path, 'rb') as f:
+			try:
+				byte_array, _ = read_tag_buffer(f)
+			except ID3Error:
+				return None, {}
+
+		header = ID3Header.from_byte_array(byte_array[0:TAG_HEADER_SIZE])
 
-		f.close()
+		wanted_frame_names = set(frame_names)
+		values = {}
+
+		try:
+			# A truncated extended header raises here, the tag is then returned without values.
+			start, end = get_frame_region(byte_array, header)
+
+			for frame_span in iter_frame_spans(byte_array, header.major_version, start, end):
+				if frame_span.name in wanted_frame_names and frame_span.name not in values:
+					body_bytes = get_frame_body(byte_array, frame_span)
+					values[frame_span.name] = ID3Columns.decode_value(frame_span.name, body_bytes, header.major_version, string_pool)
+
+					if len(values) == len(wanted_frame_names):
+						break
+		except ID3Error:
+			pass
+
+		return header, values
+
+	def decode_value(name, body_bytes, tag_version, string_pool=None):
+		try:
+			if ID3TextFrame.can_handle(name):
+				if string_pool is None:
+					texts = ID3TextFrame.decode_body(body_bytes, tag_version)
+				else:
+					texts = string_pool.decode((tag_version, bytes(body_bytes)), ID3TextFrame.decode_body)
+
+				return texts[0] if len(texts) > 0 else ''
+
+			if ID3PlayCounterFrame.can_handle(name):
+				return unpack_int(body_bytes, base=DEFAULT_BASE)
+		except (ID3Error, ValueError, IndexError):
+			return None
+
+		return bytes(body_bytes)
+
+	def __init__(self, frame_names):
+		self.frame_names = list(frame_names)
+
+		self.columns = OrderedDict()
+		self.columns['path'] = []
+		self.columns['tag_size'] = array('L')
+		self.columns['version'] = array('B')
+
+		for name in self.frame_names:
+			self.columns[name] = []
+
+	def append_file(self, path, string_pool=None):
+		header, values = ID3Columns.read_file(path, self.frame_names, string_pool)
+
+		self.columns['path'].append(path)
+		self.columns['tag_size'].append(header.tag_size if header is not None else 0)
+		self.columns['version'].append(header.major_version if header is not None else 0)
+
+		for name in self.frame_names:
+			self.columns[name].append(values.get(name))
+
+	def __getitem__(self, name):
+		return self.columns[name]
+
+	def __len__(self):
+		return len(self.columns['path'])
+
+	def to_pandas(self):
+		import pandas
+		return pandas.DataFrame(OrderedDict((name, list(column)) for name, column in self.columns.items()))
+
+	def to_arrow(self):
+		import pyarrow
+		return pyarrow.table(OrderedDict((name, list(column)) for name, column in self.columns.items()))
 
 
 class ID3Header:
@@ -371,37 +1295,172 @@ class ID3HeaderFlags:
 
 class ID3ExtendedHeader:
 
-	def from_byte_array(byte_array):
-		return ID3ExtendedHeader.from_byte_reader(ByteReader(byte_array))
+	# Extended headers of ID3v2.4 and ID3v2.3 tags are parsed, but always written as ID3v2.4. size is the number of
+	# bytes the extended header takes up in the tag, including the size field.
 
-	def from_byte_reader(br):
-		size = unpack_int(br.read(4), base=SYNCHSAFE_BASE)
-		return ID3ExtendedHeader(size)
+	def from_byte_array(byte_array, tag_version=4):
+		return ID3ExtendedHeader.from_byte_reader(ByteReader(byte_array), tag_version)
 
-	def __init__(self, size):
-		self.size = size
+	def from_byte_reader(br, tag_version=4):
+		try:
+			if tag_version == 3:
+				return ID3ExtendedHeader.from_v3_byte_reader(br)
 
+			extended_header = ID3ExtendedHeader(unpack_int(br.read(4), base=SYNCHSAFE_BASE))
 
-class ID3Body:
+			flag_bytes = br.read(br.read())
+			flags = flag_bytes[0] if len(flag_bytes) > 0 else 0
 
-	def from_byte_array(byte_array, tag_version):
-		return ID3Body.from_byte_reader(ByteReader(byte_array), tag_version)
+			# Every flag which is set is followed by the length of its data and the data.
+			if get_flag(flags, 6):
+				extended_header.is_update = True
+				br.skip(br.read())
 
-	def from_byte_reader(br, tag_version):
-		frames = []
-		while br.bytes_left() > 0 and br.peek() != 0:
-			frame = ID3Frame.from_byte_reader(br.clone(), tag_version=tag_version)
-			br.skip(FRAME_HEADER_SIZE + frame.header.body_size)
+			if get_flag(flags, 5):
+				extended_header.has_crc = True
+				extended_header.crc = unpack_int(br.read(br.read()), base=SYNCHSAFE_BASE)
 
-			frames.append(frame)
+			if get_flag(flags, 4):
+				extended_header.restrictions = ID3TagRestrictions.from_byte(br.read(br.read())[0])
+		except IndexError:
+			raise ID3IllegalFormatError('Extended header is truncated')
 
-		return ID3Body(frames)
+		return extended_header
 
-	def from_scratch():
-		return ID3Body([])
+	def from_v3_byte_reader(br):
+		extended_header = ID3ExtendedHeader(ID3ExtendedHeader.unpack_size(br.read(4), 3), tag_version=3)
 
-	def __init__(self, frames):
-		self.frames = frames
+		flags = br.read(2)
+		extended_header.padding_size = unpack_int(br.read(4), base=DEFAULT_BASE)
+
+		if get_flag(flags[0], 7):
+			extended_header.has_crc = True
+			extended_header.crc = unpack_int(br.read(4), base=DEFAULT_BASE)
+
+		return extended_header
+
+	def unpack_size(byte_array, tag_version):
+		# In ID3v2.3 the size is not synchsafe and does not include the size field itself.
+		if len(byte_array) != 4:
+			raise ID3IllegalFormatError('Extended header is truncated')
+
+		if tag_version == 3:
+			return unpack_int(byte_array, base=DEFAULT_BASE) + 4
+
+		return unpack_int(byte_array, base=SYNCHSAFE_BASE)
+
+	def from_scratch():
+		return ID3ExtendedHeader(0)
+
+	def __init__(self, size, tag_version=4):
+		self.size = size
+		self.tag_version = tag_version
+		self.is_update = False
+		self.has_crc = False
+		self.crc = 0
+		self.restrictions = None
+
+		# Only used by ID3v2.3, where the CRC does not cover the padding.
+		self.padding_size = 0
+
+	def serialize(self):
+		flags = pack_flags((False, self.is_update, self.has_crc, self.restrictions is not None, False, False, False, False))
+		flag_data = b''
+
+		if self.is_update:
+			flag_data += b'\x00'
+
+		if self.has_crc:
+			flag_data += b'\x05' + pack_int(self.crc, base=SYNCHSAFE_BASE, min_bytes=5)
+
+		if self.restrictions is not None:
+			flag_data += b'\x01' + self.restrictions.serialize()
+
+		self.size = 4 + 2 + len(flag_data)
+		self.tag_version = 4
+
+		return pack_int(self.size, base=SYNCHSAFE_BASE, min_bytes=4) + b'\x01' + flags + flag_data
+
+
+class ID3TagRestrictions:
+
+	# The restrictions of an ID3v2.4 extended header, with the values as defined by the specification, e.g.
+	# tag_size 0 means at most 128 frames and 1 MB.
+
+	def from_byte(packed_restrictions):
+		restrictions = ID3TagRestrictions()
+
+		restrictions.tag_size = packed_restrictions >> 6 & 0b11
+		restrictions.text_encoding = packed_restrictions >> 5 & 0b1
+		restrictions.text_size = packed_restrictions >> 3 & 0b11
+		restrictions.image_encoding = packed_restrictions >> 2 & 0b1
+		restrictions.image_size = packed_restrictions & 0b11
+
+		return restrictions
+
+	def __init__(self):
+		self.tag_size = 0
+		self.text_encoding = 0
+		self.text_size = 0
+		self.image_encoding = 0
+		self.image_size = 0
+
+	def serialize(self):
+		return bytes([
+			self.tag_size << 6 | self.text_encoding << 5 | self.text_size << 3 | self.image_encoding << 2 | self.image_size
+		])
+
+
+class ID3Body:
+
+	def from_byte_array(byte_array, tag_version, string_pool=None, limits=None, salvage=False):
+		return ID3Body.from_byte_reader(ByteReader(byte_array), tag_version, string_pool, limits, salvage)
+
+	def from_byte_reader(br, tag_version, string_pool=None, limits=None, salvage=False):
+		# In salvage mode, frames with an implausible header are skipped up to the next plausible frame header and
+		# frames whose body cannot be parsed are skipped as a whole. The skipped spans are kept as damaged_ranges.
+		frames = []
+		damaged_ranges = []
+
+		while br.bytes_left() > 0 and br.peek() != 0:
+			if limits is not None:
+				limits.check('max_frames', len(frames) + 1)
+
+			if not salvage:
+				frame = ID3Frame.from_byte_reader(br.clone(), tag_version=tag_version, string_pool=string_pool, limits=limits)
+				br.skip(FRAME_HEADER_SIZE + frame.header.body_size)
+
+				frames.append(frame)
+				continue
+
+			start = br.position
+			frame_end = get_plausible_frame_end(br.byte_array, start, br.end, tag_version)
+
+			if frame_end is None:
+				resync_position = find_plausible_frame_header(br.byte_array, start + 1, br.end, tag_version)
+				damaged_ranges.append((start, get_damage_end(br.byte_array, start, resync_position)))
+				br.skip(resync_position - start)
+				continue
+
+			try:
+				frames.append(
+					ID3Frame.from_byte_reader(br.clone(), tag_version=tag_version, string_pool=string_pool, limits=limits)
+				)
+			except ID3LimitExceededError:
+				raise
+			except (ID3Error, ValueError, IndexError, UnicodeError):
+				damaged_ranges.append((start, frame_end))
+
+			br.skip(frame_end - start)
+
+		return ID3Body(frames, damaged_ranges)
+
+	def from_scratch():
+		return ID3Body([])
+
+	def __init__(self, frames, damaged_ranges=None):
+		self.frames = frames
+		self.damaged_ranges = damaged_ranges or []
 
 	def find_frame_by_name(self, name):
 		matching_frames = self.find_frames_by_name(name)
@@ -420,54 +1479,140 @@ class ID3Body:
 	def add_frame(self, frame):
 		self.frames.append(frame)
 
+	def serialized_size(self):
+		return sum(f.serialized_size() for f in self.frames)
+
 	def serialize(self):
-		byte_array = b''
+		return join_buffers(self.serialize_buffers())
+
+	def serialize_buffers(self):
+		# Frames which have not been modified since they were read or last serialized are not encoded again.
+		buffers = []
 
 		for f in self.frames:
-			byte_array += f.serialize()
+			buffers.extend(f.serialize_buffers())
 
-		return byte_array
+		return buffers
 
 
 class ID3Frame:
 
+	# Frame classes are tried in the order they were registered. The from_byte_array function of a frame class gets the
+	# string pool and the limits of the tag as keyword arguments if it names them in parse_options. register_implementation replaces the list instead of
+	# modifying it, so parsing threads always see a complete registry without taking the lock. Appending to the list
+	# directly still works, but is not safe while other threads register implementations.
 	id3_frame_implementations = []
+	id3_frame_implementations_lock = threading.Lock()
 
-	def from_byte_array(byte_array, tag_version=4):
-		return ID3Frame.from_byte_reader(ByteReader(byte_array), tag_version)
+	_serialized_body = None
+	_serialized_body_unsynced = False
+
+	parse_options = ()
+
+	def register_implementation(implementation):
+		with ID3Frame.id3_frame_implementations_lock:
+			ID3Frame.id3_frame_implementations = ID3Frame.id3_frame_implementations + [implementation]
 
-	def from_byte_reader(br, tag_version):
-		header = ID3FrameHeader.from_byte_reader(br.clone(), tag_version=tag_version)
+	def from_byte_array(byte_array, tag_version=4, string_pool=None, limits=None):
+		return ID3Frame.from_byte_reader(ByteReader(byte_array), tag_version, string_pool, limits)
+
+	def from_byte_reader(br, tag_version, string_pool=None, limits=None):
+		header = ID3FrameHeader.from_byte_reader(br.clone(), tag_version=tag_version, limits=limits)
 		br.skip(header.size)
 
-		body_bytes = br.read(header.body_size)
+		raw_body_bytes = br.read(header.body_size)
+
+		body_bytes = raw_body_bytes
 		if header.format_flags.unsynced:
 			body_bytes = deunsync(body_bytes)
 
 		ID3FrameImplementation = next((f for f in ID3Frame.id3_frame_implementations if f.can_handle(header.name)), ID3UnknownFrame)
-		return ID3FrameImplementation.from_byte_array(header, body_bytes)
+
+		parse_options = getattr(ID3FrameImplementation, 'parse_options', ())
+		options = {
+			name: value for name, value in (('string_pool', string_pool), ('limits', limits))
+			if value is not None and name in parse_options
+		}
+
+		frame = ID3FrameImplementation.from_byte_array(header, body_bytes, **options)
+
+		# Until an attribute is modified, the frame serializes to exactly the bytes it was read from.
+		frame._serialized_body = [raw_body_bytes]
+		frame._serialized_body_unsynced = header.format_flags.unsynced
+
+		return frame
 
 	def __init__(self, header):
 		self.header = header
 		self.name = header.name
 
+	def __reduce__(self):
+		return (ID3Frame.from_byte_array, (self.get_pickled_bytes(), self.header.tag_version))
+
+	def get_pickled_bytes(self, tag_version=None):
+		# The frame is encoded for tag_version, by default the version it was read with, and its header is not changed.
+		if tag_version is None:
+			tag_version = self.header.tag_version
+
+		serialized_body = join_buffers(self.get_serialized_body_buffers())
+		base = SYNCHSAFE_BASE if tag_version == 4 else DEFAULT_BASE
+
+		return self.header.serialize(len(serialized_body), base) + serialized_body
+
+	def __setattr__(self, name, value):
+		if not name.startswith('_'):
+			self.mark_dirty()
+
+		super(ID3Frame, self).__setattr__(name, value)
+
+	@property
+	def dirty(self):
+		return self._serialized_body is None
+
+	def mark_dirty(self):
+		# Attribute assignments mark the frame as dirty automatically. This has to be called explicitly only
+		# after modifying a mutable attribute in place, e.g. a bytearray.
+		self._serialized_body = None
+
+	def serialize_body_buffers(self):
+		return [self.serialize_body()]
+
+	def get_serialized_body_buffers(self):
+		unsynced = self.header.format_flags.unsynced
+
+		if self.dirty or self._serialized_body_unsynced != unsynced:
+			serialized_body = self.serialize_body_buffers()
+			if unsynced:
+				serialized_body = [unsync(join_buffers(serialized_body))]
+
+			self._serialized_body = serialized_body
+			self._serialized_body_unsynced = unsynced
+
+		return self._serialized_body
+
+	def serialized_size(self):
+		# Frames which have not been modified use the size of their cached body. Other frames are encoded, and the
+		# result is cached for when the frame is serialized.
+		return FRAME_HEADER_SIZE + sum(len(b) for b in self.get_serialized_body_buffers())
+
 	def serialize(self):
-		serialized_body = self.serialize_body()
-		if self.header.format_flags.unsynced:
-			serialized_body = unsync(serialized_body)
+		return join_buffers(self.serialize_buffers())
 
-		self.header.body_size = len(serialized_body)
+	def serialize_buffers(self):
+		serialized_body = self.get_serialized_body_buffers()
+
+		self.header.body_size = sum(len(b) for b in serialized_body)
 		serialized_header = self.header.serialize()
 
-		return serialized_header + serialized_body
+		return [serialized_header] + serialized_body
 
 
 class ID3FrameHeader:
 
-	def from_byte_array(byte_array, tag_version=4):
-		return ID3FrameHeader.from_byte_reader(ByteReader(byte_array), tag_version)
+	def from_byte_array(byte_array, tag_version=4, limits=None):
+		return ID3FrameHeader.from_byte_reader(ByteReader(byte_array), tag_version, limits)
 
-	def from_byte_reader(br, tag_version):
+	def from_byte_reader(br, tag_version, limits=None):
 		name = br.read(4).decode('ascii')
 
 		body_size_bytes = br.read(4)
@@ -492,6 +1637,12 @@ class ID3FrameHeader:
 			uncompressed_body_size = unpack_int(br.read(4), base=SYNCHSAFE_BASE)
 			total_size += 4
 
+		if limits is not None:
+			limits.check('max_frame_size', body_size)
+
+			if uncompressed_body_size is not None:
+				limits.check('max_decompressed_size', uncompressed_body_size)
+
 		if format_flags.compressed:
 			raise ID3UnsupportedFeatureError('Compression of frames is currently not supported')
 
@@ -505,7 +1656,8 @@ class ID3FrameHeader:
 			status_flags,
 			format_flags,
 			uncompressed_body_size,
-			grouping_id
+			grouping_id,
+			tag_version
 		)
 
 	def from_name(name):
@@ -514,7 +1666,7 @@ class ID3FrameHeader:
 
 		return ID3FrameHeader(name, None, None, default_status_flags, default_format_flags, None, None)
 
-	def __init__(self, name, size, body_size, status_flags, format_flags, uncompressed_body_size, grouping_id):
+	def __init__(self, name, size, body_size, status_flags, format_flags, uncompressed_body_size, grouping_id, tag_version=4):
 		self.name = name
 		self.size = size
 		self.body_size = body_size
@@ -525,9 +1677,14 @@ class ID3FrameHeader:
 		self.grouping_id = grouping_id
 		self.uncompressed_body_size = uncompressed_body_size
 
-	def serialize(self):
+		self.tag_version = tag_version
+
+	def serialize(self, body_size=None, base=SYNCHSAFE_BASE):
+		if body_size is None:
+			body_size = self.body_size
+
 		serialized_frame_name = self.name.encode('ascii')
-		serialized_body_size = pack_int(self.body_size, base=SYNCHSAFE_BASE, min_bytes=4)
+		serialized_body_size = pack_int(body_size, base=base, min_bytes=4)
 		serialized_status_flags = self.status_flags.serialize()
 		serialized_format_flags = self.format_flags.serialize()
 
@@ -598,6 +1755,8 @@ class ID3FrameFormatFlags:
 
 class ID3TextFrame(ID3Frame):
 
+	parse_options = ('string_pool',)
+
 	def can_handle(name):
 		if name[0] == 'T' and name != 'TXXX':
 			return True
@@ -607,22 +1766,68 @@ class ID3TextFrame(ID3Frame):
 
 		return False
 
-	def from_byte_array(header, byte_array):
-		br = ByteReader(byte_array)
+	def from_byte_array(header, byte_array, string_pool=None):
+		if string_pool is None:
+			texts = ID3TextFrame.decode_body(byte_array, header.tag_version)
+		else:
+			texts = string_pool.decode((header.tag_version, bytes(byte_array)), ID3TextFrame.decode_body)
 
-		encoding_byte = br.read()
-		encoding, terminator = decode_text_encoding(encoding_byte)
+		return ID3TextFrame(header, texts)
 
-		encoded_text = ID3TextFrame.get_encoded_text(br.tail(), terminator)
-		text = encoded_text.decode(encoding)
+	def decode_body(byte_array, tag_version):
+		encoding, terminator = decode_text_encoding(byte_array[0])
 
-		return ID3TextFrame(header, text)
+		if tag_version < 4:
+			encoded_text = ID3TextFrame.get_encoded_text(byte_array, terminator, 1)
+			return [encoded_text.decode(encoding)]
+
+		return ID3TextFrame.decode_texts(byte_array, encoding, terminator, 1)
+
+	def decode_texts(byte_array, encoding, terminator, start=0):
+		# ID3v2.4 separates multiple values with the terminator. All values are decoded at once and the decoded text is
+		# split, instead of searching and slicing the byte array value by value.
+		end = len(byte_array)
+		if (end - start) % len(terminator) == 0 and byte_array.endswith(terminator, start):
+			end -= len(terminator)
 
-	def get_encoded_text(byte_array, terminator):
 		try:
-			return extract_terminated_string(byte_array, terminator)
-		except ValueError:
-			return byte_array
+			text = byte_array[start:end].decode(encoding)
+		except UnicodeDecodeError:
+			# Garbage after the first value, only the first value is used.
+			return [ID3TextFrame.get_encoded_text(byte_array, terminator, start).decode(encoding)]
+
+		texts = text.split('\x00')
+
+		# With UTF-16, every value starts with its own byte order mark, but only the first one is consumed by the decoder.
+		# A value whose byte order differs from the first one decodes to a swapped mark and has to be decoded on its own.
+		if any(t.startswith('\ufffe') for t in texts[1:]):
+			texts = ID3TextFrame.decode_each_text(byte_array, encoding, terminator, start, end)
+		else:
+			texts = [texts[0]] + [t[1:] if t.startswith('\ufeff') else t for t in texts[1:]]
+
+		while len(texts) > 1 and texts[-1] == '':
+			texts.pop()
+
+		return texts
+
+	def decode_each_text(byte_array, encoding, terminator, start, end):
+		texts = []
+
+		while True:
+			span = find_terminated_string(byte_array, terminator, start, end)
+			if span is None:
+				texts.append(byte_array[start:end].decode(encoding))
+				return texts
+
+			texts.append(byte_array[span[0]:span[1]].decode(encoding))
+			start = span[1] + len(terminator)
+
+	def get_encoded_text(byte_array, terminator, start=0):
+		span = find_terminated_string(byte_array, terminator, start)
+		if span is None:
+			return byte_array[start:]
+
+		return byte_array[span[0]:span[1]]
 
 	def from_scratch(name, text):
 		if not ID3TextFrame.can_handle(name):
@@ -633,18 +1838,102 @@ class ID3TextFrame(ID3Frame):
 
 	def __init__(self, header, text):
 		super(ID3TextFrame, self).__init__(header)
-		self.text = text
+
+		if isinstance(text, str):
+			self.text = text
+		else:
+			self.texts = list(text)
+
+	@property
+	def texts(self):
+		return self._texts
+
+	@texts.setter
+	def texts(self, texts):
+		# The values are copied, so frames never share a list, e.g. one handed out by a string pool.
+		self._texts = ID3FrameList(texts, self)
+
+	@property
+	def text(self):
+		if len(self.texts) == 0:
+			return ''
+
+		return self.texts[0]
+
+	@text.setter
+	def text(self, text):
+		self.texts = [text]
 
 	def serialize_body(self):
 		encoding = b'\x03'
 		string_terminator = b'\x00'
 
-		return encoding + self.text.encode('utf-8') + string_terminator
+		return encoding + '\x00'.join(self.texts).encode('utf-8') + string_terminator
 
 	def __str__(self):
-		return self.name + ': ' + self.text
+		return self.name + ': ' + ' / '.join(self.texts)
+
+ID3Frame.register_implementation(ID3TextFrame)
+
+
+def marking_frame_dirty(method):
+	@functools.wraps(method)
+	def mutate(self, *args, **kwargs):
+		result = method(self, *args, **kwargs)
+		self.frame.mark_dirty()
+
+		return result
+
+	return mutate
+
+def track_frame_mutations(container_class, method_names):
+	# Wraps the given methods of container_class, so changing a container of a frame in place marks the frame as
+	# modified.
+	base_class = container_class.__bases__[0]
+
+	for method_name in method_names:
+		setattr(container_class, method_name, marking_frame_dirty(getattr(base_class, method_name)))
+
+
+LIST_MUTATING_METHODS = (
+	'__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+	'reverse'
+)
+
+ARRAY_MUTATING_METHODS = (
+	'__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'reverse',
+	'byteswap', 'frombytes', 'fromfile', 'fromlist'
+)
+
+class ID3FrameList(list):
+
+	# A list attribute of a frame, e.g. the values of a text frame. Changing it in place marks the frame as modified,
+	# so the cached body is not written instead of the new values.
+
+	def __init__(self, values, frame):
+		super(ID3FrameList, self).__init__(values)
+		self.frame = frame
+
+	def __reduce__(self):
+		return (ID3FrameList, (list(self), self.frame))
+
+track_frame_mutations(ID3FrameList, LIST_MUTATING_METHODS)
+
+
+class ID3FrameArray(array):
+
+	# Like ID3FrameList, but for an array attribute of a frame, e.g. the timestamps of synchronized lyrics.
+
+	def __new__(cls, typecode, values, frame):
+		frame_array = super(ID3FrameArray, cls).__new__(cls, typecode, values)
+		frame_array.frame = frame
 
-ID3Frame.id3_frame_implementations.append(ID3TextFrame)
+		return frame_array
+
+	def __reduce_ex__(self, protocol):
+		return (ID3FrameArray, (self.typecode, list(self), self.frame))
+
+track_frame_mutations(ID3FrameArray, ARRAY_MUTATING_METHODS)
 
 
 class ID3CommentFrame(ID3Frame):
@@ -653,19 +1942,15 @@ class ID3CommentFrame(ID3Frame):
 		return name == 'COMM'
 
 	def from_byte_array(header, byte_array):
-		br = ByteReader(byte_array)
-
-		encoding_byte = br.read()
-		encoding, terminator = decode_text_encoding(encoding_byte)
+		encoding, terminator = decode_text_encoding(byte_array[0])
 
-		language = br.read(3).decode('iso-8859-1')
+		language = byte_array[1:4].decode('iso-8859-1')
 
-		encoded_description = extract_terminated_string(br.tail(), terminator)
+		encoded_description = extract_terminated_string(byte_array, terminator, 4)
 		description = encoded_description.decode(encoding)
 
-		br.skip(len(encoded_description) + len(terminator))
-		encoded_comment = br.tail()
-		comment = encoded_comment.decode(encoding)
+		comment_start = 4 + len(encoded_description) + len(terminator)
+		comment = byte_array[comment_start:].decode(encoding)
 
 		return ID3CommentFrame(header, language, description, comment)
 
@@ -692,7 +1977,7 @@ class ID3CommentFrame(ID3Frame):
 	def __str__(self):
 		return self.name + ': ' + self.comment
 
-ID3Frame.id3_frame_implementations.append(ID3CommentFrame)
+ID3Frame.register_implementation(ID3CommentFrame)
 
 
 class ID3PopularimeterFrame(ID3Frame):
@@ -701,14 +1986,12 @@ class ID3PopularimeterFrame(ID3Frame):
 		return name == 'POPM'
 
 	def from_byte_array(header, byte_array):
-		br = ByteReader(byte_array)
-
-		encoded_email = extract_terminated_string(br.tail(), b'\x00')
+		encoded_email = extract_terminated_string(byte_array, b'\x00')
 		email = encoded_email.decode('iso-8859-1')
-		br.skip(len(encoded_email + b'\x00'))
 
-		rating = br.read()
-		play_counter = unpack_int(br.tail(), base=DEFAULT_BASE)
+		rating_position = len(encoded_email) + 1
+		rating = byte_array[rating_position]
+		play_counter = unpack_int(byte_array[rating_position + 1:], base=DEFAULT_BASE)
 
 		return ID3PopularimeterFrame(header, email, rating, play_counter)
 
@@ -741,7 +2024,7 @@ class ID3PopularimeterFrame(ID3Frame):
 
 		return email + rating + play_counter
 
-ID3Frame.id3_frame_implementations.append(ID3PopularimeterFrame)
+ID3Frame.register_implementation(ID3PopularimeterFrame)
 
 
 class ID3PlayCounterFrame(ID3Frame):
@@ -764,7 +2047,336 @@ class ID3PlayCounterFrame(ID3Frame):
 	def serialize_body(self):
 		return pack_int(self.play_counter, base=DEFAULT_BASE, min_bytes=4)
 
-ID3Frame.id3_frame_implementations.append(ID3PlayCounterFrame)
+ID3Frame.register_implementation(ID3PlayCounterFrame)
+
+
+class ID3SynchronizedLyricsFrame(ID3Frame):
+
+	# Timestamps are kept sorted in an array, so the text at a point in time is found by bisection. Changing the
+	# timestamps or the texts in place marks the frame as modified.
+
+	TIMESTAMP_MPEG_FRAMES = 1
+	TIMESTAMP_MILLISECONDS = 2
+
+	def can_handle(name):
+		return name == 'SYLT'
+
+	def from_byte_array(header, byte_array):
+		encoding, terminator = decode_text_encoding(byte_array[0])
+
+		language = byte_array[1:4].decode('iso-8859-1')
+		timestamp_format = byte_array[4]
+		content_type = byte_array[5]
+
+		encoded_description = extract_terminated_string(byte_array, terminator, 6)
+		description = encoded_description.decode(encoding)
+
+		entries = []
+		position = 6 + len(encoded_description) + len(terminator)
+
+		while position < len(byte_array):
+			encoded_text = extract_terminated_string(byte_array, terminator, position)
+			position += len(encoded_text) + len(terminator)
+
+			if position + 4 > len(byte_array):
+				raise ID3IllegalFormatError('Timestamp of synchronized text exceeds the frame')
+
+			entries.append((unpack_int(byte_array[position:position + 4], base=DEFAULT_BASE), encoded_text.decode(encoding)))
+			position += 4
+
+		return ID3SynchronizedLyricsFrame(header, language, description, entries, timestamp_format, content_type)
+
+	def from_scratch(language, description, entries, timestamp_format=TIMESTAMP_MILLISECONDS, content_type=1):
+		header = ID3FrameHeader.from_name('SYLT')
+		return ID3SynchronizedLyricsFrame(header, language, description, entries, timestamp_format, content_type)
+
+	def __init__(self, header, language, description, entries, timestamp_format, content_type):
+		super(ID3SynchronizedLyricsFrame, self).__init__(header)
+
+		self.language = language
+		self.description = description
+		self.timestamp_format = timestamp_format
+		self.content_type = content_type
+		self.entries = entries
+
+	@property
+	def entries(self):
+		return list(zip(self.timestamps, self.texts))
+
+	@entries.setter
+	def entries(self, entries):
+		# Entries are (timestamp, text) pairs, which are sorted by their timestamps.
+		entries = sorted(entries, key=lambda entry: entry[0])
+
+		self.timestamps = [timestamp for timestamp, _ in entries]
+		self.texts = [text for _, text in entries]
+
+	@property
+	def timestamps(self):
+		return self._timestamps
+
+	@timestamps.setter
+	def timestamps(self, timestamps):
+		self._timestamps = ID3FrameArray('I', timestamps, self)
+
+	@property
+	def texts(self):
+		return self._texts
+
+	@texts.setter
+	def texts(self, texts):
+		self._texts = ID3FrameList(texts, self)
+
+	def index_at(self, timestamp):
+		# Returns the index of the entry which is active at the given time, or -1 before the first entry.
+		return bisect.bisect_right(self.timestamps, timestamp) - 1
+
+	def text_at(self, timestamp):
+		index = self.index_at(timestamp)
+		return self.texts[index] if index >= 0 else None
+
+	def serialize_body(self):
+		encoding = b'\x03'
+		language = self.language.encode('ascii')
+		formats = bytes([self.timestamp_format, self.content_type])
+		description = self.description.encode('utf-8') + b'\x00'
+
+		entries = b''.join(
+			text.encode('utf-8') + b'\x00' + pack_int(timestamp, base=DEFAULT_BASE, min_bytes=4)
+			for timestamp, text in zip(self.timestamps, self.texts)
+		)
+
+		return encoding + language + formats + description + entries
+
+	def __str__(self):
+		return self.name + ': ' + ' / '.join(self.texts)
+
+ID3Frame.register_implementation(ID3SynchronizedLyricsFrame)
+
+
+SUB_FRAME_CONTAINERS = ('CHAP', 'CTOC')
+
+def parse_sub_frames(byte_array, position, tag_version, string_pool=None, limits=None):
+	# Chapters and tables of contents must not be nested in sub frames, which bounds the recursion. The frame
+	# headers are checked before any sub frame is parsed.
+	for frame_span in iter_frame_spans(byte_array, tag_version, position):
+		if frame_span.name in SUB_FRAME_CONTAINERS:
+			raise ID3IllegalFormatError('%s frame at %d is nested in a sub frame' % (frame_span.name, frame_span.start))
+
+	return ID3Body.from_byte_reader(ByteReader(byte_array, position), tag_version, string_pool, limits).frames
+
+
+class ID3SubFrameContainer(ID3Frame):
+
+	# Base of frames which embed other frames. The frame counts as modified if its list of sub frames or any of the
+	# sub frames is modified.
+
+	parse_options = ('string_pool', 'limits')
+
+	@property
+	def sub_frames(self):
+		return self._sub_frames
+
+	@sub_frames.setter
+	def sub_frames(self, sub_frames):
+		self._sub_frames = ID3FrameList(sub_frames, self)
+
+	@property
+	def dirty(self):
+		return self._serialized_body is None or any(f.dirty for f in self.sub_frames)
+
+
+class ID3ChapterFrame(ID3SubFrameContainer):
+
+	# Times are in milliseconds. Offsets are in bytes and 0xffffffff if unused. The sub frames, e.g. a TIT2 with the
+	# title of the chapter, are parsed like the frames of the tag.
+
+	UNUSED_OFFSET = 0xffffffff
+
+	def can_handle(name):
+		return name == 'CHAP'
+
+	def from_byte_array(header, byte_array, string_pool=None, limits=None):
+		encoded_element_id = extract_terminated_string(byte_array, b'\x00')
+		position = len(encoded_element_id) + 1
+
+		if position + 16 > len(byte_array):
+			raise ID3IllegalFormatError('Chapter times exceed the frame')
+
+		start_time, end_time, start_offset, end_offset = (
+			unpack_int(byte_array[p:p + 4], base=DEFAULT_BASE) for p in range(position, position + 16, 4)
+		)
+
+		sub_frames = parse_sub_frames(byte_array, position + 16, header.tag_version, string_pool, limits)
+
+		return ID3ChapterFrame(
+			header, encoded_element_id.decode('iso-8859-1'), start_time, end_time, sub_frames, start_offset, end_offset
+		)
+
+	def from_scratch(element_id, start_time, end_time, sub_frames=None):
+		header = ID3FrameHeader.from_name('CHAP')
+		return ID3ChapterFrame(header, element_id, start_time, end_time, sub_frames or [])
+
+	def __init__(self, header, element_id, start_time, end_time, sub_frames, start_offset=UNUSED_OFFSET, end_offset=UNUSED_OFFSET):
+		super(ID3ChapterFrame, self).__init__(header)
+
+		self.element_id = element_id
+		self.start_time = start_time
+		self.end_time = end_time
+		self.start_offset = start_offset
+		self.end_offset = end_offset
+		self.sub_frames = sub_frames
+
+	@property
+	def title(self):
+		titles = [f.text for f in self.sub_frames if f.name == 'TIT2']
+		return titles[0] if len(titles) > 0 else None
+
+	def serialize_body(self):
+		element_id = self.element_id.encode('iso-8859-1') + b'\x00'
+		times = b''.join(
+			pack_int(t, base=DEFAULT_BASE, min_bytes=4)
+			for t in (self.start_time, self.end_time, self.start_offset, self.end_offset)
+		)
+
+		return element_id + times + ID3Body(self.sub_frames).serialize()
+
+	def __str__(self):
+		return self.name + ': ' + self.element_id
+
+ID3Frame.register_implementation(ID3ChapterFrame)
+
+
+class ID3TableOfContentsFrame(ID3SubFrameContainer):
+
+	# Lists the element ids of chapters or nested tables of contents.
+
+	def can_handle(name):
+		return name == 'CTOC'
+
+	def from_byte_array(header, byte_array, string_pool=None, limits=None):
+		encoded_element_id = extract_terminated_string(byte_array, b'\x00')
+		position = len(encoded_element_id) + 1
+
+		if position + 2 > len(byte_array):
+			raise ID3IllegalFormatError('Table of contents flags exceed the frame')
+
+		flags = byte_array[position]
+		entry_count = byte_array[position + 1]
+		position += 2
+
+		child_element_ids = []
+		for _ in range(entry_count):
+			encoded_child_element_id = extract_terminated_string(byte_array, b'\x00', position)
+			child_element_ids.append(encoded_child_element_id.decode('iso-8859-1'))
+			position += len(encoded_child_element_id) + 1
+
+		sub_frames = parse_sub_frames(byte_array, position, header.tag_version, string_pool, limits)
+
+		return ID3TableOfContentsFrame(
+			header, encoded_element_id.decode('iso-8859-1'), child_element_ids, get_flag(flags, 1), get_flag(flags, 0),
+			sub_frames
+		)
+
+	def from_scratch(element_id, child_element_ids, top_level=True, ordered=True, sub_frames=None):
+		header = ID3FrameHeader.from_name('CTOC')
+		return ID3TableOfContentsFrame(header, element_id, child_element_ids, top_level, ordered, sub_frames or [])
+
+	def __init__(self, header, element_id, child_element_ids, top_level, ordered, sub_frames):
+		super(ID3TableOfContentsFrame, self).__init__(header)
+
+		self.element_id = element_id
+		self.child_element_ids = child_element_ids
+		self.top_level = top_level
+		self.ordered = ordered
+		self.sub_frames = sub_frames
+
+	def serialize_body(self):
+		element_id = self.element_id.encode('iso-8859-1') + b'\x00'
+		flags = pack_flags((False, False, False, False, False, False, self.top_level, self.ordered))
+		child_element_ids = b''.join(e.encode('iso-8859-1') + b'\x00' for e in self.child_element_ids)
+
+		return element_id + flags + bytes([len(self.child_element_ids)]) + child_element_ids + ID3Body(self.sub_frames).serialize()
+
+	def __str__(self):
+		return self.name + ': ' + ', '.join(self.child_element_ids)
+
+ID3Frame.register_implementation(ID3TableOfContentsFrame)
+
+
+class ID3ChapterIndex:
+
+	# Finds the chapter at a point in time by bisecting the start times of the chapters of a tag.
+
+	def from_id3(id3):
+		return ID3ChapterIndex(id3.find_frames_by_name('CHAP'))
+
+	def __init__(self, chapters):
+		self.chapters = sorted(chapters, key=lambda chapter: chapter.start_time)
+		self.start_times = array('I', [chapter.start_time for chapter in self.chapters])
+		self.end_times = array('I', [chapter.end_time for chapter in self.chapters])
+
+	def chapter_at(self, time):
+		index = bisect.bisect_right(self.start_times, time) - 1
+
+		if index < 0 or time >= self.end_times[index]:
+			return None
+
+		return self.chapters[index]
+
+	def __len__(self):
+		return len(self.chapters)
+
+
+class ID3PictureSource:
+
+	# A picture which stays in a file or a stream and is read chunk by chunk when the tag is written, instead of being
+	# held in memory. Streams have to be seekable.
+
+	def from_file(path_or_stream):
+		if hasattr(path_or_stream, 'read'):
+			offset = path_or_stream.tell()
+			size = path_or_stream.seek(0, os.SEEK_END) - offset
+			return ID3PictureSource(None, path_or_stream, offset, size)
+
+		return ID3PictureSource(path_or_stream, None, 0, os.path.getsize(path_or_stream))
+
+	def __init__(self, path, stream, offset, size):
+		self.path = path
+		self.stream = stream
+		self.offset = offset
+		self.size = size
+
+	def __len__(self):
+		return self.size
+
+	def is_in_file(self, path):
+		return self.path is not None and os.path.exists(path) and os.path.samefile(self.path, path)
+
+	def iter_chunks(self, chunk_size=64 * 1024):
+		if self.stream is not None:
+			for chunk in self.iter_stream_chunks(self.stream, chunk_size):
+				yield chunk
+			return
+
+		with open(self.path, 'rb') as stream:
+			for chunk in self.iter_stream_chunks(stream, chunk_size):
+				yield chunk
+
+	def iter_stream_chunks(self, stream, chunk_size):
+		stream.seek(self.offset)
+		remaining = self.size
+
+		while remaining > 0:
+			chunk = stream.read(min(chunk_size, remaining))
+			if len(chunk) == 0:
+				raise ID3IllegalFormatError('Picture ended %d bytes early' % remaining)
+
+			remaining -= len(chunk)
+			yield chunk
+
+	def read(self):
+		return b''.join(self.iter_chunks())
 
 
 class ID3PictureFrame(ID3Frame):
@@ -773,22 +2385,19 @@ class ID3PictureFrame(ID3Frame):
 		return name == 'APIC'
 
 	def from_byte_array(header, byte_array):
-		br = ByteReader(byte_array)
-
-		encoding_byte = br.read()
-		encoding, terminator = decode_text_encoding(encoding_byte)
+		encoding, terminator = decode_text_encoding(byte_array[0])
 
-		encoded_mime_type = extract_terminated_string(br.tail(), b'\x00')
-		br.skip(len(encoded_mime_type) + 1)
+		encoded_mime_type = extract_terminated_string(byte_array, b'\x00', 1)
 		mime_type = encoded_mime_type.decode('iso-8859-1')
 
-		picture_type = br.read()
+		picture_type_position = 1 + len(encoded_mime_type) + 1
+		picture_type = byte_array[picture_type_position]
 
-		encoded_description = extract_terminated_string(br.tail(), terminator)
-		br.skip(len(encoded_description) + len(terminator))
+		encoded_description = extract_terminated_string(byte_array, terminator, picture_type_position + 1)
 		description = encoded_description.decode(encoding)
 
-		binary_picture = br.tail()
+		picture_start = picture_type_position + 1 + len(encoded_description) + len(terminator)
+		binary_picture = byte_array[picture_start:]
 
 		return ID3PictureFrame(header, mime_type, picture_type, description, binary_picture)
 
@@ -796,6 +2405,47 @@ class ID3PictureFrame(ID3Frame):
 		header = ID3FrameHeader.from_name('APIC')
 		return ID3PictureFrame(header, mime_type, picture_type, description, binary_picture)
 
+	def from_picture_file(mime_type, picture_type, description, path_or_stream):
+		# The picture is not read until the tag is written.
+		binary_picture = ID3PictureSource.from_file(path_or_stream)
+		return ID3PictureFrame.from_scratch(mime_type, picture_type, description, binary_picture)
+
+	def iter_from_file(path):
+		# Yields the pictures of the tag of the given file, without reading the pictures themselves. Their
+		# binary_picture is a ID3PictureSource referring to the file.
+		with open(path, 'rb') as f:
+			header, start, end = read_tag_header(f)
+
+			for frame_span in iter_file_frame_spans(f, header.major_version, start, end):
+				if ID3PictureFrame.can_handle(frame_span.name):
+					yield ID3PictureFrame.read_from_file(f, path, frame_span, header.major_version)
+
+	def read_from_file(f, path, frame_span, tag_version):
+		header = ID3FrameHeader.from_byte_array(read_at(f, frame_span.start, frame_span.body_start - frame_span.start), tag_version)
+		body_size = frame_span.body_end - frame_span.body_start
+
+		if header.format_flags.unsynced:
+			return ID3PictureFrame.from_byte_array(header, read_frame_body(f, frame_span))
+
+		# Reads more and more of the body, until the mime type and the description are complete.
+		head_size = min(body_size, 1024)
+		while True:
+			head = read_at(f, frame_span.body_start, head_size)
+
+			try:
+				frame = ID3PictureFrame.from_byte_array(header, head)
+				break
+			except (ValueError, IndexError):
+				if head_size >= body_size:
+					raise ID3IllegalFormatError('Picture frame at %d is malformed' % frame_span.start)
+
+				head_size = min(body_size, head_size * 16)
+
+		picture_start = frame_span.body_start + len(head) - len(frame.binary_picture)
+		frame.binary_picture = ID3PictureSource(path, None, picture_start, frame_span.body_end - picture_start)
+
+		return frame
+
 	def __init__(self, header, mime_type, picture_type, description, binary_picture):
 		super(ID3PictureFrame, self).__init__(header)
 
@@ -805,17 +2455,177 @@ class ID3PictureFrame(ID3Frame):
 		self.binary_picture = binary_picture
 
 	def serialize_body(self):
-		body = bytearray()
+		return join_buffers(self.serialize_body_buffers())
+
+	def serialize_body_buffers(self):
+		# The picture is passed on as a separate buffer, so it is not copied during serialization.
+		head = bytearray()
+
+		head.append(0x03)
+		head.extend(self.mime_type.encode('iso-8859-1') + b'\x00')
+		head.append(self.picture_type)
+		head.extend(self.description.encode('utf-8') + b'\x00')
+
+		return [head, self.binary_picture]
+
+	def extract_picture(self, output, chunk_size=64 * 1024):
+		# Writes the picture to a path or a stream chunk by chunk.
+		if not hasattr(output, 'write'):
+			with open(output, 'wb') as f:
+				return self.extract_picture(f, chunk_size)
+
+		if isinstance(self.binary_picture, ID3PictureSource):
+			chunks = self.binary_picture.iter_chunks(chunk_size)
+		else:
+			view = memoryview(self.binary_picture)
+			chunks = (view[i:i + chunk_size] for i in range(0, len(view), chunk_size))
+
+		for chunk in chunks:
+			output.write(chunk)
+
+ID3Frame.register_implementation(ID3PictureFrame)
+
+
+ID3AlbumArtwork = namedtuple('ID3AlbumArtwork', ('tracks', 'pictures', 'unique_pictures', 'size', 'unique_size'))
 
-		body.append(0x03)
-		body.extend(self.mime_type.encode('iso-8859-1') + b'\x00')
-		body.append(self.picture_type)
-		body.extend(self.description.encode('utf-8') + b'\x00')
-		body.extend(self.binary_picture)
+class ID3ArtworkStore:
+
+	# Content addressed store of the pictures of a library. Pictures are hashed chunk by chunk while scanning and
+	# every unique picture is kept once, together with the number of pictures referring to it. Without a directory,
+	# only the hashes are kept.
+
+	def __init__(self, directory=None, hash_name='sha256'):
+		self.directory = directory
+		self.hash_name = hash_name
+
+		self.refcounts = {}
+		self.sizes = {}
+		self.references = OrderedDict()
+		self.albums = OrderedDict()
+
+	def scan(self, paths):
+		for path in paths:
+			try:
+				self.add_file(path)
+			except ID3Error:
+				pass
+
+	def add_file(self, path):
+		# Only the album name is decoded, the pictures are read chunk by chunk.
+		album = None
+		frames = []
+
+		with open(path, 'rb') as f:
+			header, start, end = read_tag_header(f)
+
+			for frame_span in iter_file_frame_spans(f, header.major_version, start, end):
+				if frame_span.name == 'TALB' and album is None:
+					album = ID3Columns.decode_value('TALB', read_frame_body(f, frame_span), header.major_version)
+				elif ID3PictureFrame.can_handle(frame_span.name):
+					frames.append(ID3PictureFrame.read_from_file(f, path, frame_span, header.major_version))
+
+		return [self.add_frame(frame, path, album) for frame in frames]
+
+	def add_frame(self, frame, path=None, album=None):
+		digest = self.store_picture(frame.binary_picture)
+
+		self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+		self.references.setdefault(path, []).append(digest)
+		self.albums.setdefault(album, []).append((path, digest))
+
+		return digest
+
+	def store_picture(self, binary_picture):
+		# The picture is hashed first and only written if its digest is new, so a duplicate is read once and never
+		# written. A new picture from a file is read a second time to be written.
+		picture_hash = hashlib.new(self.hash_name)
+		size = 0
+
+		for chunk in ID3ArtworkStore.iter_picture_chunks(binary_picture):
+			picture_hash.update(chunk)
+			size += len(chunk)
+
+		digest = picture_hash.hexdigest()
+		self.sizes[digest] = size
+
+		if self.directory is not None and digest not in self.refcounts and not os.path.exists(self.get_picture_path(digest)):
+			picture_file = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+
+			try:
+				with picture_file:
+					for chunk in ID3ArtworkStore.iter_picture_chunks(binary_picture):
+						picture_file.write(chunk)
+
+				os.replace(picture_file.name, self.get_picture_path(digest))
+			except BaseException:
+				os.remove(picture_file.name)
+				raise
+
+		return digest
+
+	def iter_picture_chunks(binary_picture):
+		if isinstance(binary_picture, ID3PictureSource):
+			return binary_picture.iter_chunks()
+
+		return [binary_picture]
+
+	def release(self, digest, path=None):
+		# Drops one reference of the file at path to the picture. The picture is removed once it is not referenced
+		# anymore.
+		self.refcounts[digest] -= 1
+
+		digests = self.references.get(path, [])
+		if digest in digests:
+			digests.remove(digest)
+			if len(digests) == 0:
+				del self.references[path]
+
+		for album, pictures in self.albums.items():
+			if (path, digest) in pictures:
+				pictures.remove((path, digest))
+				if len(pictures) == 0:
+					del self.albums[album]
+				break
+
+		if self.refcounts[digest] > 0:
+			return
+
+		del self.refcounts[digest]
+		del self.sizes[digest]
+
+		if self.directory is not None:
+			os.remove(self.get_picture_path(digest))
+
+	def get_picture_path(self, digest):
+		if self.directory is None:
+			raise ValueError('Pictures are only stored if a directory is given')
+
+		return os.path.join(self.directory, digest)
+
+	@property
+	def size(self):
+		return sum(self.sizes[digest] * refcount for digest, refcount in self.refcounts.items())
 
-		return body
+	@property
+	def unique_size(self):
+		return sum(self.sizes[digest] for digest in self.refcounts)
+
+	def album_report(self):
+		report = OrderedDict()
+
+		for album, pictures in self.albums.items():
+			digests = [digest for _, digest in pictures]
+			unique_digests = set(digests)
+
+			report[album] = ID3AlbumArtwork(
+				len(set(path for path, _ in pictures)),
+				len(digests),
+				len(unique_digests),
+				sum(self.sizes[digest] for digest in digests),
+				sum(self.sizes[digest] for digest in unique_digests)
+			)
 
-ID3Frame.id3_frame_implementations.append(ID3PictureFrame)
+		return report
 
 
 class ID3UnknownFrame(ID3Frame):
@@ -872,3 +2682,744 @@ class ID3UnsupportedFeatureError(ID3Error):
 
 	def __str__(self):
 		return repr(self.value)
+
+
+class ID3LimitExceededError(ID3Error):
+
+	def __init__(self, value):
+		super(ID3LimitExceededError, self).__init__(value)
+
+	def __str__(self):
+		return repr(self.value)
+
+
+def iter_files(directory):
+	for entry in iter_file_entries(directory):
+		yield entry.path
+
+def iter_file_entries(directory):
+	# Walks the directory tree with os.scandir, which provides the file type without an additional stat call.
+	directories = [directory]
+
+	while len(directories) > 0:
+		with os.scandir(directories.pop()) as entries:
+			entries = sorted(entries, key=lambda e: e.name)
+
+		for entry in entries:
+			if entry.is_file():
+				yield entry
+
+		directories.extend(reversed([e.path for e in entries if e.is_dir(follow_symlinks=False)]))
+
+def imap_bounded(executor, function, iterable, window):
+	# Like executor.map, but with at most window tasks in flight. Results are yielded in order and tasks are only
+	# submitted as fast as the results are consumed.
+	futures = deque()
+
+	for item in iterable:
+		futures.append(executor.submit(function, item))
+
+		if len(futures) >= window:
+			yield futures.popleft().result()
+
+	while len(futures) > 0:
+		yield futures.popleft().result()
+
+def scan_file(path, frame_names):
+	record = OrderedDict()
+	record['path'] = path
+
+	try:
+		header, values = ID3Columns.read_file(path, frame_names)
+	except OSError as e:
+		record['error'] = str(e)
+		return record
+
+	record['version'] = header.major_version if header is not None else None
+	record['tag_size'] = header.tag_size if header is not None else 0
+	record['frames'] = OrderedDict()
+
+	for name in frame_names:
+		value = values.get(name)
+		if isinstance(value, bytes):
+			value = value.hex()
+
+		record['frames'][name] = value
+
+	return record
+
+def format_record(record, jsonl):
+	if jsonl:
+		return json.dumps(record, ensure_ascii=False)
+
+	if 'error' in record:
+		return '%s\terror=%s' % (record['path'], record['error'])
+
+	fields = ['%s=%s' % (name, value) for name, value in record['frames'].items() if value is not None]
+	return '\t'.join([record['path']] + fields)
+
+def scan(directory, frame_names, jobs=1, jsonl=False, output=sys.stdout, statistics=sys.stderr):
+	start = time.perf_counter()
+	files = 0
+	tags = 0
+	tag_bytes = 0
+
+	scan_path = functools.partial(scan_file, frame_names=frame_names)
+
+	if jobs > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+		records = imap_bounded(executor, scan_path, iter_files(directory), window=jobs * 16)
+	else:
+		executor = None
+		records = map(scan_path, iter_files(directory))
+
+	try:
+		for record in records:
+			output.write(format_record(record, jsonl) + '\n')
+
+			files += 1
+			if record.get('version') is not None:
+				tags += 1
+				tag_bytes += record['tag_size']
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	duration = time.perf_counter() - start
+	statistics.write('Scanned %d files with %d tags (%.1f MB) in %.2f s, %.1f files/s\n' % (
+		files, tags, tag_bytes / 1e6, duration, files / duration if duration > 0 else 0
+	))
+
+def match_value(predicate, value):
+	# A predicate is a value to compare with, a compiled regular expression which is searched in text values, or a
+	# callable which gets the value.
+	if value is None:
+		return False
+
+	if hasattr(predicate, 'search'):
+		return isinstance(value, str) and predicate.search(value) is not None
+
+	if callable(predicate):
+		return bool(predicate(value))
+
+	return predicate == value
+
+def decode_frame_values(name, body_bytes, tag_version):
+	# Text frames may hold several values, other frames are decoded to one value like in ID3Columns.
+	if ID3TextFrame.can_handle(name):
+		try:
+			return ID3TextFrame.decode_body(body_bytes, tag_version)
+		except (ID3Error, ValueError, IndexError):
+			return []
+
+	return [ID3Columns.decode_value(name, body_bytes, tag_version)]
+
+def match_file(path, where):
+	# Returns whether every predicate in where matches a frame with its name. Only the frame headers are read, and the
+	# bodies of frames with a predicate. Reading stops as soon as the result is known: when all predicates matched,
+	# or when a predicate did not match a frame which may only occur once in a tag.
+	remaining = dict(where)
+
+	try:
+		with open(path, 'rb') as f:
+			header, start, end = read_tag_header(f)
+			if len(remaining) == 0:
+				return True
+
+			for frame_span in iter_file_frame_spans(f, header.major_version, start, end):
+				if frame_span.name not in remaining:
+					continue
+
+				body_bytes = read_frame_body(f, frame_span)
+				values = decode_frame_values(frame_span.name, body_bytes, header.major_version)
+
+				if any(match_value(remaining[frame_span.name], value) for value in values):
+					del remaining[frame_span.name]
+
+					if len(remaining) == 0:
+						return True
+				elif ID3TextFrame.can_handle(frame_span.name) or ID3PlayCounterFrame.can_handle(frame_span.name):
+					return False
+	except (OSError, ID3Error):
+		return False
+
+	return False
+
+def find(paths, where, jobs=1):
+	# Yields the paths whose tags match all predicates in where, a dict from frame names to predicates (see
+	# match_value), in the order of paths. Files are matched on a pool of threads, so predicates need not be
+	# picklable.
+	def match(path):
+		return path, match_file(path, where)
+
+	if jobs > 1:
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+		results = imap_bounded(executor, match, paths, window=jobs * 16)
+	else:
+		executor = None
+		results = map(match, paths)
+
+	try:
+		for path, matches in results:
+			if matches:
+				yield path
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+def verify_tag_crc(path, chunk_size=1024 * 1024):
+	# Returns whether the CRC of the extended header matches the tag, or None if the file has no tag or the tag has no
+	# CRC. The frame region is streamed through zlib.crc32, no frame is decoded.
+	with open(path, 'rb') as f:
+		try:
+			header = ID3Header.from_byte_array(f.read(TAG_HEADER_SIZE))
+			if not header.flags.has_extended_header:
+				return None
+
+			extended_header = read_extended_header(f, header.major_version)
+		except ID3Error:
+			return None
+
+		if not extended_header.has_crc:
+			return None
+
+		remaining = header.tag_size - extended_header.size - extended_header.padding_size
+		crc = 0
+
+		while remaining > 0:
+			chunk = f.read(min(chunk_size, remaining))
+			if len(chunk) == 0:
+				return False
+
+			crc = zlib.crc32(chunk, crc)
+			remaining -= len(chunk)
+
+		return crc == extended_header.crc
+
+def verify_file(path):
+	try:
+		return path, verify_tag_crc(path)
+	except OSError:
+		return path, None
+
+def verify(directory, jobs=1, output=sys.stdout, statistics=sys.stderr):
+	# Prints every file whose tag has a CRC with "ok" or "corrupt", and returns the number of corrupt tags.
+	start = time.perf_counter()
+	files = 0
+	checked = 0
+	corrupt = 0
+
+	if jobs > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+		results = imap_bounded(executor, verify_file, iter_files(directory), window=jobs * 16)
+	else:
+		executor = None
+		results = map(verify_file, iter_files(directory))
+
+	try:
+		for path, result in results:
+			files += 1
+			if result is None:
+				continue
+
+			checked += 1
+			if not result:
+				corrupt += 1
+
+			output.write('%s\t%s\n' % (path, 'ok' if result else 'corrupt'))
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	duration = time.perf_counter() - start
+	statistics.write('Verified %d of %d files in %.2f s, %d corrupt\n' % (checked, files, duration, corrupt))
+
+	return corrupt
+
+def compact_file(path, max_padding=4096, drop_frame_names=('PRIV',), reencode_utf16=True, deduplicate_pictures=True, atomic=True):
+	# Drops frames by name and pictures which occur more than once with the same type and description, re-encodes
+	# UTF-16 text as UTF-8 and cuts the padding down to max_padding. The file is only written if anything changes, and
+	# unless atomic is unset, a shrunk file is written as a new file, so a crash never leaves a half-moved file.
+	# Returns a record with the number of bytes reclaimed.
+	record = OrderedDict()
+	record['path'] = path
+
+	try:
+		with open(path, 'rb') as f:
+			ID3Header.from_byte_array(f.read(TAG_HEADER_SIZE))
+	except ID3Error:
+		record['reclaimed'] = 0
+		return record
+	except OSError as e:
+		record['error'] = str(e)
+		return record
+
+	# These frames start with the encoding of their text and are written as UTF-8.
+	text_frame_types = (ID3TextFrame, ID3CommentFrame, ID3PictureFrame, ID3SynchronizedLyricsFrame)
+
+	try:
+		size_before = os.stat(path).st_size
+
+		# Unlike ID3.from_file, a tag which cannot be parsed is not replaced by an empty one.
+		with open(path, 'rb') as f:
+			id3 = ID3.from_input_stream(f)
+
+		frames = []
+		picture_keys = set()
+
+		for frame in id3.frames:
+			if frame.name in drop_frame_names:
+				continue
+
+			if deduplicate_pictures and isinstance(frame, ID3PictureFrame):
+				picture_key = (frame.picture_type, frame.description, hashlib.sha1(frame.binary_picture).digest())
+				if picture_key in picture_keys:
+					continue
+
+				picture_keys.add(picture_key)
+
+			if reencode_utf16 and isinstance(frame, text_frame_types) and frame.get_serialized_body_buffers()[0][0] in (0x01, 0x02):
+				frame.mark_dirty()
+
+			frames.append(frame)
+
+		dropped_frames = len(id3.frames) - len(frames)
+		id3.body.frames = frames
+
+		padding = TAG_HEADER_SIZE + id3.header.tag_size - id3.serialized_size()
+		if dropped_frames > 0 or any(f.dirty for f in frames) or padding > max_padding:
+			id3.to_file(path, atomic=atomic, max_padding=max_padding)
+	except (ID3Error, OSError, ValueError, IndexError, UnicodeError) as e:
+		# A malformed file is recorded and must not stop compacting the others.
+		record['error'] = str(e)
+		return record
+
+	record['dropped_frames'] = dropped_frames
+	record['reclaimed'] = size_before - os.stat(path).st_size
+
+	return record
+
+def compact(paths, jobs=1, output=sys.stdout, statistics=sys.stderr, **options):
+	# Compacts the files with compact_file on worker processes and returns the number of bytes reclaimed.
+	start = time.perf_counter()
+	files = 0
+	reclaimed = 0
+
+	compact_path = functools.partial(compact_file, **options)
+
+	if jobs > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+		records = imap_bounded(executor, compact_path, paths, window=jobs * 16)
+	else:
+		executor = None
+		records = map(compact_path, paths)
+
+	try:
+		for record in records:
+			files += 1
+			reclaimed += record.get('reclaimed', 0)
+
+			if record.get('reclaimed', 0) > 0 or 'error' in record:
+				output.write(json.dumps(record, ensure_ascii=False) + '\n')
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+	duration = time.perf_counter() - start
+	statistics.write('Compacted %d files in %.2f s, reclaimed %.1f MB\n' % (files, duration, reclaimed / 1e6))
+
+	return reclaimed
+
+ID3ManifestEntry = namedtuple('ID3ManifestEntry', ('path', 'size', 'mtime_ns', 'inode', 'tag_size', 'tag_hash'))
+ID3ManifestEvent = namedtuple('ID3ManifestEvent', ('kind', 'path', 'entry', 'id3'))
+
+class ID3Manifest:
+
+	# Remembers the files of a directory tree and their tags between scans. A scan stats every file, but only opens
+	# and parses files which are new or whose size, modification time or inode changed.
+
+	ADDED = 'added'
+	CHANGED = 'changed'
+	REMOVED = 'removed'
+
+	def from_file(path):
+		entries = OrderedDict()
+
+		with open(path, 'r', encoding='utf-8') as f:
+			for line in f:
+				entry = ID3ManifestEntry(*json.loads(line))
+				entries[entry.path] = entry
+
+		return ID3Manifest(entries)
+
+	def from_scratch():
+		return ID3Manifest(OrderedDict())
+
+	def __init__(self, entries):
+		self.entries = entries
+
+	def to_file(self, path):
+		temporary_path = path + '.tmp'
+
+		with open(temporary_path, 'w', encoding='utf-8') as f:
+			for entry in self.entries.values():
+				f.write(json.dumps(list(entry), ensure_ascii=False) + '\n')
+
+		os.replace(temporary_path, path)
+
+	def scan(self, directory):
+		# Yields an event for every added, changed and removed file. A file whose tag is unchanged does not cause an
+		# event, even if the file itself changed. The manifest is updated while scanning.
+		seen_paths = set()
+
+		for dir_entry in iter_file_entries(directory):
+			try:
+				stat = dir_entry.stat()
+			except OSError:
+				continue
+
+			seen_paths.add(dir_entry.path)
+			previous_entry = self.entries.get(dir_entry.path)
+
+			if previous_entry is not None and previous_entry[1:4] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+				continue
+
+			try:
+				id3, tag_bytes = ID3Manifest.read_tag(dir_entry.path)
+			except OSError:
+				seen_paths.discard(dir_entry.path)
+				continue
+
+			tag_hash = hashlib.sha1(tag_bytes).hexdigest() if tag_bytes is not None else None
+			tag_size = id3.header.tag_size
+
+			entry = ID3ManifestEntry(dir_entry.path, stat.st_size, stat.st_mtime_ns, stat.st_ino, tag_size, tag_hash)
+			self.entries[dir_entry.path] = entry
+
+			if previous_entry is None:
+				yield ID3ManifestEvent(ID3Manifest.ADDED, dir_entry.path, entry, id3)
+			elif previous_entry.tag_hash != tag_hash:
+				yield ID3ManifestEvent(ID3Manifest.CHANGED, dir_entry.path, entry, id3)
+
+		for path in [p for p in self.entries if p not in seen_paths]:
+			entry = self.entries.pop(path)
+			yield ID3ManifestEvent(ID3Manifest.REMOVED, path, entry, None)
+
+	def read_tag(path):
+		# Like ID3.from_file, but also returns the raw tag, which is hashed.
+		with open(path, 'rb') as f:
+			try:
+				tag_bytes = read_tag_bytes(f)
+				id3 = ID3.from_byte_array(tag_bytes)
+			except (ID3Error, ValueError, IndexError, UnicodeError):
+				# A damaged tag must not stop a scan, the file is treated as untagged.
+				tag_bytes = None
+				id3 = ID3.from_scratch()
+
+		id3.initial_path = path
+		return id3, tag_bytes
+
+	def __len__(self):
+		return len(self.entries)
+
+def diff_tags(old_id3, new_id3):
+	# Returns the frames which differ between two tags, grouped by name: {name: (old frames, new frames)}. Either tag
+	# may be None.
+	def group_frames(id3):
+		frames = OrderedDict()
+
+		if id3 is not None:
+			for frame in id3.frames:
+				frames.setdefault(frame.name, []).append(frame)
+
+		return frames
+
+	old_frames = group_frames(old_id3)
+	new_frames = group_frames(new_id3)
+
+	diff = OrderedDict()
+
+	for name in list(old_frames) + [n for n in new_frames if n not in old_frames]:
+		old = old_frames.get(name, [])
+		new = new_frames.get(name, [])
+
+		if [f.serialize() for f in old] != [f.serialize() for f in new]:
+			diff[name] = (old, new)
+
+	return diff
+
+
+class ID3Inotify:
+
+	# Minimal inotify binding, which watches a directory tree and reports the paths of written, moved and deleted
+	# files. Only available on Linux.
+
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ISDIR = 0x40000000
+
+	IN_NONBLOCK = 0o4000
+	IN_CLOEXEC = 0o2000000
+
+	WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+	EVENT_HEADER = struct.Struct('iIII')
+
+	def is_available():
+		return hasattr(load_libc(), 'inotify_init1')
+
+	def __init__(self, directory):
+		self.libc = load_libc()
+		if not hasattr(self.libc, 'inotify_init1'):
+			raise OSError('inotify is not available')
+
+		self.fd = self.libc.inotify_init1(ID3Inotify.IN_NONBLOCK | ID3Inotify.IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+		self.directories = {}
+		self.add_tree(directory)
+
+	def add_tree(self, directory):
+		# Returns the files in the tree, which may have been written before the watch was added.
+		self.add_watch(directory)
+
+		files = []
+		for root, directories, file_names in os.walk(directory):
+			for d in directories:
+				self.add_watch(os.path.join(root, d))
+
+			files.extend(os.path.join(root, f) for f in file_names)
+
+		return files
+
+	def add_watch(self, directory):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), ID3Inotify.WATCH_MASK)
+		if wd >= 0:
+			self.directories[wd] = directory
+
+	def read_paths(self, timeout):
+		# Returns the changed paths and whether events have been lost, in which case everything has to be rescanned.
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if len(readable) == 0:
+			return [], False
+
+		try:
+			buffer = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return [], False
+
+		paths = []
+		overflow = False
+		offset = 0
+
+		while offset < len(buffer):
+			wd, mask, _, length = ID3Inotify.EVENT_HEADER.unpack_from(buffer, offset)
+			offset += ID3Inotify.EVENT_HEADER.size
+
+			name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\x00'))
+			offset += length
+
+			if mask & ID3Inotify.IN_Q_OVERFLOW:
+				overflow = True
+				continue
+
+			if mask & (ID3Inotify.IN_IGNORED | ID3Inotify.IN_DELETE_SELF):
+				self.directories.pop(wd, None)
+				continue
+
+			directory = self.directories.get(wd)
+			if directory is None:
+				continue
+
+			path = os.path.join(directory, name)
+
+			if mask & ID3Inotify.IN_ISDIR:
+				if mask & (ID3Inotify.IN_CREATE | ID3Inotify.IN_MOVED_TO):
+					paths.extend(self.add_tree(path))
+			elif not mask & ID3Inotify.IN_CREATE:
+				paths.append(path)
+
+		return paths, overflow
+
+	def close(self):
+		os.close(self.fd)
+
+
+class ID3Watcher:
+
+	# Follows a directory tree and calls callback(path, id3, diff) whenever the tag of a file changed, where diff is
+	# the result of diff_tags against the tag seen before. id3 is None if the file has been removed. Bursts of writes
+	# to a file are debounced, tags are parsed on a bounded pool of worker threads. Uses inotify on Linux and polls
+	# the tree otherwise.
+
+	def __init__(self, directory, callback, jobs=4, debounce=0.5, poll_interval=2.0, use_inotify=True):
+		self.directory = directory
+		self.callback = callback
+		self.debounce = debounce
+		self.poll_interval = poll_interval
+
+		self.inotify = None
+		if use_inotify and ID3Inotify.is_available():
+			self.inotify = ID3Inotify(directory)
+
+		self.snapshot = None
+		if self.inotify is None:
+			self.snapshot = self.take_snapshot()
+
+		self.tags = {}
+		self.pending = OrderedDict()
+		self.in_progress = set()
+		self.lock = threading.Lock()
+
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+		self.slots = threading.BoundedSemaphore(jobs * 4)
+		self.stopped = threading.Event()
+
+	def start(self):
+		thread = threading.Thread(target=self.run, daemon=True)
+		thread.start()
+
+		return thread
+
+	def stop(self):
+		self.stopped.set()
+
+	def run(self):
+		try:
+			while not self.stopped.is_set():
+				self.collect_changes()
+				self.process_pending(time.monotonic())
+		finally:
+			self.executor.shutdown(wait=True)
+
+			if self.inotify is not None:
+				self.inotify.close()
+
+	def collect_changes(self):
+		if self.inotify is not None:
+			paths, overflow = self.inotify.read_paths(timeout=min(self.debounce, 0.5))
+			if overflow:
+				paths = list(self.tags) + list(iter_files(self.directory))
+		else:
+			self.stopped.wait(self.poll_interval)
+			paths = self.poll_changes()
+
+		now = time.monotonic()
+		for path in paths:
+			self.pending.pop(path, None)
+			self.pending[path] = now
+
+	def take_snapshot(self):
+		snapshot = {}
+
+		for dir_entry in iter_file_entries(self.directory):
+			try:
+				stat = dir_entry.stat()
+			except OSError:
+				continue
+
+			snapshot[dir_entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+		return snapshot
+
+	def poll_changes(self):
+		snapshot = self.take_snapshot()
+
+		paths = [p for p, s in snapshot.items() if self.snapshot.get(p) != s]
+		paths.extend(p for p in self.snapshot if p not in snapshot)
+
+		self.snapshot = snapshot
+		return paths
+
+	def process_pending(self, now):
+		# Pending paths are ordered by the time of their last change.
+		while len(self.pending) > 0:
+			path, changed_at = next(iter(self.pending.items()))
+			if now - changed_at < self.debounce:
+				return
+
+			with self.lock:
+				if path in self.in_progress:
+					return
+
+				self.in_progress.add(path)
+
+			del self.pending[path]
+
+			self.slots.acquire()
+			self.executor.submit(self.process, path)
+
+	def process(self, path):
+		try:
+			try:
+				id3 = ID3.from_file(path)
+			except OSError:
+				id3 = None
+			except ID3Error:
+				return
+
+			previous_id3 = self.tags.get(path)
+			diff = diff_tags(previous_id3, id3)
+
+			if id3 is None:
+				self.tags.pop(path, None)
+			else:
+				self.tags[path] = id3
+
+			if len(diff) > 0 or (previous_id3 is None) != (id3 is None):
+				self.callback(path, id3, diff)
+		finally:
+			with self.lock:
+				self.in_progress.discard(path)
+
+			self.slots.release()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m id3parse')
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+
+	scan_parser = commands.add_parser('scan', help='Print the frames of all files in a directory tree')
+	scan_parser.add_argument('directory')
+	scan_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+	scan_parser.add_argument('--frames', default='TIT2,TPE1,TALB', help='Comma separated frame names')
+	scan_parser.add_argument('--jsonl', action='store_true', help='Print one JSON record per file')
+
+	verify_parser = commands.add_parser('verify', help='Check the CRCs of all tags in a directory tree')
+	verify_parser.add_argument('directory')
+	verify_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+
+	compact_parser = commands.add_parser('compact', help='Shrink the tags of all files in a directory tree')
+	compact_parser.add_argument('directory')
+	compact_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+	compact_parser.add_argument('--max-padding', type=int, default=4096, help='Padding to keep in bytes')
+	compact_parser.add_argument('--drop', default='PRIV', help='Comma separated names of frames to drop')
+
+	args = parser.parse_args(argv)
+
+	if args.command == 'scan':
+		frame_names = [name for name in args.frames.split(',') if name != '']
+		scan(args.directory, frame_names, args.jobs, args.jsonl)
+	elif args.command == 'verify':
+		return 1 if verify(args.directory, args.jobs) > 0 else 0
+	elif args.command == 'compact':
+		drop_frame_names = tuple(name for name in args.drop.split(',') if name != '')
+		compact(
+			iter_files(args.directory), args.jobs, max_padding=args.max_padding, drop_frame_names=drop_frame_names
+		)
+
+	return 0
+
+
+if __name__ == '__main__':
+	# The module is imported under its own name, so worker processes find the functions in id3parse and not in
+	# __main__.
+	import id3parse
+	sys.exit(id3parse.main())
@@ -0,0 +1,115 @@
+import io
+import os
+import sys
+import time
+import pickle
+import copyreg
+import concurrent.futures
+
+from id3parse import *
+
+
+def make_tag(frame_count, picture_size):
+	id3 = ID3.from_scratch()
+
+	for i in range(frame_count):
+		id3.add_frame(ID3TextFrame.from_scratch('T%03d' % i, 'Value of frame %d' % i))
+		id3.add_frame(ID3UnknownFrame.from_scratch('PRIV', b'WM/Provider\x00' + bytes([i % 256]) * 32))
+
+	if picture_size > 0:
+		id3.add_frame(ID3PictureFrame.from_scratch('image/jpeg', ID3PictureTypes.FRONT_COVER, 'Cover', b'\x42' * picture_size))
+
+	return ID3.from_byte_array(id3.serialize())
+
+
+class ObjectGraphPickler(pickle.Pickler):
+
+	# Pickles ID3 objects and frames the way pickle does without their __reduce__ methods.
+
+	def reducer_override(self, obj):
+		if isinstance(obj, (ID3, ID3Frame)):
+			return (copyreg.__newobj__, (type(obj),), obj.__dict__)
+
+		return NotImplemented
+
+
+def dumps_object_graph(obj):
+	f = io.BytesIO()
+	ObjectGraphPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+	return f.getvalue()
+
+
+def measure(dumps, obj, repetitions, access_frames):
+	start = time.perf_counter()
+
+	for _ in range(repetitions):
+		pickled = dumps(obj)
+		unpickled = pickle.loads(pickled)
+
+		if access_frames:
+			unpickled.frames
+
+	return len(pickled), (time.perf_counter() - start) / repetitions
+
+
+def bench_pickle(repetitions=200):
+	# The serialized tag is parsed lazily, so it is measured with and without accessing the frames after unpickling.
+	methods = (
+		('object graph', dumps_object_graph, False),
+		('serialized', pickle.dumps, False),
+		('serialized, parsed', pickle.dumps, True)
+	)
+
+	print('%-28s %-20s %12s %12s' % ('tag', 'pickling', 'bytes', 'ms/roundtrip'))
+
+	for frame_count, picture_size in ((10, 0), (100, 0), (100, 1024 * 1024)):
+		id3 = make_tag(frame_count, picture_size)
+		name = '%d frames, %d KB picture' % (2 * frame_count, picture_size // 1024)
+
+		for method, dumps, access_frames in methods:
+			size, duration = measure(dumps, id3, repetitions, access_frames)
+			print('%-28s %-20s %12d %12.3f' % (name, method, size, duration * 1000))
+
+
+def parse_and_serialize(byte_array, repetitions):
+	for _ in range(repetitions):
+		id3 = ID3.from_byte_array(byte_array)
+		id3.find_frame_by_name('T000').text = 'Modified'
+		id3.serialize()
+
+
+def bench_threads(repetitions=500, max_threads=None):
+	# Every thread parses and serializes its own tags. Without a GIL, the throughput should grow with the threads.
+	byte_array = make_tag(20, 0).serialize()
+	max_threads = max_threads or os.cpu_count() or 1
+	gil_enabled = sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+
+	print('GIL %s' % ('enabled' if gil_enabled else 'disabled'))
+	print('%-8s %12s %10s' % ('threads', 'tags/s', 'speedup'))
+
+	thread_counts = sorted(set([2 ** i for i in range(max_threads.bit_length()) if 2 ** i <= max_threads] + [max_threads]))
+	single_thread_rate = None
+
+	for threads in thread_counts:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+			start = time.perf_counter()
+			futures = [executor.submit(parse_and_serialize, byte_array, repetitions) for _ in range(threads)]
+			for future in futures:
+				future.result()
+			duration = time.perf_counter() - start
+
+		rate = threads * repetitions / duration
+		single_thread_rate = single_thread_rate or rate
+		print('%-8d %12.0f %10.2f' % (threads, rate, rate / single_thread_rate))
+
+
+BENCHMARKS = {
+	'pickle': bench_pickle,
+	'threads': bench_threads
+}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] or sorted(BENCHMARKS)
+
+	for name in names:
+		BENCHMARKS[name]()
@@ -1,8 +1,41 @@
+import gc
+import io
+import os
+import re
+import json
+import zlib
+import time
+import queue
+import pickle
 import unittest
 import tempfile
+import threading
+import warnings
 
 from id3parse import *
 
+class TestByteReader(unittest.TestCase):
+
+	def test_clone_is_limited_and_advances_the_reader(self):
+		br = ByteReader(b'abcdef', 1)
+		clone = br.clone(2)
+
+		self.assertEqual(b'bc', clone.read(5))
+		self.assertEqual(0, clone.bytes_left())
+		self.assertEqual(ord('d'), br.read())
+		self.assertEqual(b'ef', br.tail())
+
+	def test_reading_past_the_end(self):
+		br = ByteReader(b'abcdef', 4, 5)
+		br.skip(3)
+
+		self.assertEqual(0, br.bytes_left())
+		self.assertEqual(b'', br.read(2))
+
+		with self.assertRaises(IndexError):
+			br.peek()
+
+
 class TestID3Header(unittest.TestCase):
 
 	def test_header_creation_fails_if_wrong_test_identifier_is_present(self):
@@ -92,10 +125,58 @@ class TestID3(unittest.TestCase):
 
 	def test_serialization_with_extended_header(self):
 		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
 		id3.header.flags.has_extended_header = True
+		id3.extended_header = ID3ExtendedHeader.from_scratch()
+		id3.extended_header.is_update = True
+		id3.extended_header.has_crc = True
+		id3.extended_header.restrictions = ID3TagRestrictions.from_byte(0b10101101)
 
-		with self.assertRaises(ID3UnsupportedFeatureError):
-			id3.serialize()
+		serialized_tag = id3.serialize(min_length=100)
+		self.assertEqual(100, len(serialized_tag))
+		self.assertEqual(b'\x00\x00\x00\x0f\x01\x70\x00\x05', serialized_tag[10:18])
+
+		id3 = ID3.from_byte_array(serialized_tag)
+		self.assertEqual('Welcome', id3.find_frame_by_name('TIT2').text)
+		self.assertEqual(15, id3.extended_header.size)
+		self.assertTrue(id3.extended_header.is_update)
+		self.assertEqual(zlib.crc32(serialized_tag[25:]), id3.extended_header.crc)
+		self.assertEqual(0b10101101, id3.extended_header.restrictions.serialize()[0])
+		self.assertEqual(2, id3.extended_header.restrictions.tag_size)
+		self.assertEqual(1, id3.extended_header.restrictions.image_size)
+		self.assertEqual(serialized_tag, id3.serialize(min_length=100))
+
+	def test_extended_header_of_v3_tag(self):
+		frame = b'TIT2\x00\x00\x00\x08\x00\x00\x00Welcome'
+		extended_header = b'\x00\x00\x00\x0a\x80\x00\x00\x00\x00\x05' + zlib.crc32(frame).to_bytes(4, 'big')
+		byte_array = b'ID3\x03\x00\x40\x00\x00\x00\x25' + extended_header + frame + b'\x00' * 5
+
+		id3 = ID3.from_byte_array(byte_array)
+
+		self.assertEqual('Welcome', id3.find_frame_by_name('TIT2').text)
+		self.assertEqual(14, id3.extended_header.size)
+		self.assertEqual(5, id3.extended_header.padding_size)
+		self.assertEqual(zlib.crc32(frame), id3.extended_header.crc)
+
+		path = self.make_mp3(byte_array)
+		self.assertTrue(verify_tag_crc(path))
+
+	def test_verify_tag_crc(self):
+		id3 = self.make_id3()
+		id3.header.flags.has_extended_header = True
+		id3.extended_header = ID3ExtendedHeader.from_scratch()
+		id3.extended_header.has_crc = True
+
+		path = self.make_mp3(id3.serialize(min_length=60))
+		self.assertTrue(verify_tag_crc(path))
+
+		with open(path, 'r+b') as f:
+			f.seek(40)
+			f.write(b'\x01')
+
+		self.assertFalse(verify_tag_crc(path))
+		self.assertIsNone(verify_tag_crc(self.make_mp3_with_tag()))
+		self.assertIsNone(verify_tag_crc(self.make_mp3()))
 
 	def test_write_to_file_where_file_contains_bigger_tag(self):
 		path = self.make_mp3_with_tag_and_padding()
@@ -138,6 +219,273 @@ class TestID3(unittest.TestCase):
 		self.verify_id3(path)
 		self.verify_mp3(path)
 
+	def test_write_to_file_with_unchanged_tag_size(self):
+		id3 = self.make_id3()
+		id3.add_frame(ID3PlayCounterFrame.from_scratch(30))
+		path = self.make_mp3(id3.serialize(min_length=60))
+
+		id3 = ID3.from_file(path)
+		id3.find_frame_by_name('PCNT').play_counter = 31
+		id3.to_file()
+
+		id3 = ID3.from_file(path)
+		self.assertEqual(31, id3.find_frame_by_name('PCNT').play_counter)
+		self.assertEqual(50, id3.header.tag_size)
+		self.verify_mp3(path)
+
+	def test_write_to_file_atomically(self):
+		path = self.make_mp3_with_tag()
+		os.chmod(path, 0o644)
+		inode = os.stat(path).st_ino
+
+		id3 = ID3.from_file(path)
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+		id3.to_file(atomic=True)
+
+		self.verify_id3(path)
+		self.verify_mp3(path)
+		self.assertNotEqual(inode, os.stat(path).st_ino)
+		self.assertEqual(0o644, os.stat(path).st_mode & 0o777)
+
+	def test_write_session(self):
+		grown_path = self.make_mp3_with_tag()
+		padded_path = self.make_mp3_with_tag_and_padding()
+
+		with ID3WriteSession(batch_size=1) as session:
+			for path in (grown_path, padded_path):
+				id3 = ID3.from_file(path)
+				id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+				session.write(id3)
+
+		for path in (grown_path, padded_path):
+			self.verify_id3(path)
+			self.verify_mp3(path)
+
+		self.assertEqual(2, session.files)
+		self.assertEqual(2, session.batches)
+		self.assertEqual(['write', 'sync', 'replace'], list(session.timings))
+		self.assertEqual([], [n for n in os.listdir(os.path.dirname(grown_path)) if n.startswith('.' + os.path.basename(grown_path))])
+
+	def test_write_session_writes_same_file_twice(self):
+		path = self.make_mp3_with_tag()
+
+		with ID3WriteSession() as session:
+			id3 = ID3.from_file(path)
+			id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+			session.write(id3)
+
+			# Fits into the old file and is written in place.
+			id3 = ID3.from_file(path)
+			id3.find_frame_by_name('TPE1').text = 'Offspring'
+			session.write(id3)
+
+		id3 = ID3.from_file(path)
+		self.assertEqual('Offspring', id3.find_frame_by_name('TPE1').text)
+		self.assertEqual([], id3.find_frames_by_name('TIT2'))
+		self.verify_mp3(path)
+		self.assertEqual(2, session.batches)
+
+	def test_read_ahead_covers_small_tag(self):
+		stream = CountingStream(TestID3.test_average_case_data + b'\xff\xf0...the.mp3.file...')
+		id3 = ID3.from_input_stream(stream)
+
+		self.assertEqual(21, len(id3.frames))
+		self.assertEqual(1, stream.reads)
+		self.assertEqual(len(TestID3.test_average_case_data), stream.tell())
+
+	def test_read_ahead_with_tag_bigger_than_read_ahead(self):
+		serialized_tag = ID3.from_byte_array(TestID3.test_average_case_data).serialize(min_length=100000)
+		stream = CountingStream(serialized_tag + b'\xff\xf0...the.mp3.file...')
+
+		self.assertEqual(serialized_tag, read_tag_bytes(stream))
+		self.assertEqual([65536, len(serialized_tag) - 65536], stream.sizes)
+		self.assertEqual(len(serialized_tag), stream.tell())
+
+	def test_read_ahead_from_unseekable_stream(self):
+		stream = CountingStream(TestID3.test_average_case_data + b'\xff\xf0...the.mp3.file...', seekable=False)
+
+		self.assertEqual(TestID3.test_average_case_data, read_tag_bytes(stream))
+		self.assertEqual(b'\xff\xf0...the.mp3.file...', stream.read())
+
+	def test_fingerprint_ignores_padding(self):
+		id3 = ID3.from_byte_array(TestID3.test_average_case_data)
+		path = self.make_mp3(id3.serialize())
+
+		id3.header.flags.has_extended_header = True
+		padded_path = self.make_mp3(id3.serialize(min_length=4000))
+
+		self.assertEqual(32, len(ID3.fingerprint(path)))
+		self.assertEqual(ID3.fingerprint(path), ID3.fingerprint(padded_path))
+
+		id3.find_frame_by_name('TIT2').text = 'Pretty Fly'
+		id3.to_file(padded_path)
+
+		self.assertNotEqual(ID3.fingerprint(path), ID3.fingerprint(padded_path))
+		self.assertIsNone(ID3.fingerprint(self.make_mp3()))
+
+	def test_fingerprint_of_damaged_tag(self):
+		damaged_path = self.make_mp3(b'ID3\x04\x00\x00\x00\x00\x00\x0fT\xc4T2\x00\x00\x00\x05\x00\x00\x03Ab\x00\x00')
+		self.assertEqual(32, len(ID3.fingerprint(damaged_path)))
+
+		unsupported_path = self.make_mp3(b'ID3\x05\x00\x00\x00\x00\x00\x0fTIT2\x00\x00\x00\x05\x00\x00\x03Ab\x00\x00')
+		self.assertIsNone(ID3.fingerprint(unsupported_path))
+
+	def test_write_to_stream_replaces_existing_tag(self):
+		old_tag = self.make_id3().serialize(min_length=300)
+		audio_stream = TrickleStream(old_tag + b'\xff\xf0...the.mp3.file...', max_read=7)
+
+		id3 = self.make_id3()
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+
+		output = io.BytesIO()
+		written = id3.to_stream(output, audio_stream, chunk_size=16)
+
+		self.assertEqual(id3.serialize() + b'\xff\xf0...the.mp3.file...', output.getvalue())
+		self.assertEqual(len(output.getvalue()), written)
+
+	def test_write_to_stream_without_existing_tag(self):
+		for audio in (b'\xff\xf0...the.mp3.file...', b'\xff\xf0'):
+			id3 = self.make_id3()
+
+			output = io.BytesIO()
+			id3.to_stream(output, TrickleStream(audio, max_read=3))
+
+			self.assertEqual(id3.serialize() + audio, output.getvalue())
+
+	def test_serialized_size(self):
+		id3 = ID3.from_byte_array(TestID3.test_average_case_data)
+		id3.find_frame_by_name('TIT2').text = 'Welcome'
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', b'\xff\xf0' * 1000))
+
+		for has_extended_header, has_footer, min_length in ((False, False, 0), (True, True, 0), (True, False, 4000)):
+			id3.header.flags.has_extended_header = has_extended_header
+			id3.header.flags.has_footer = has_footer
+
+			self.assertEqual(len(id3.serialize(min_length)), id3.serialized_size(min_length))
+
+	def test_write_to_file_with_max_padding_shrinks_tag(self):
+		for atomic in (False, True):
+			path = self.make_mp3(self.make_id3().serialize(min_length=5000))
+
+			id3 = ID3.from_file(path)
+			id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+			id3.to_file(atomic=atomic, max_padding=20)
+
+			self.verify_id3(path)
+			self.verify_mp3(path)
+			self.assertEqual(id3.serialized_size() + 20 + 20, os.stat(path).st_size)
+
+	def test_salvage_frames_around_damage(self):
+		frames = (
+			b'TPE1\x00\x00\x00\x0f\x00\x00\x03The Offspring\x00'
+			b'\x01\x02garbage'
+			b'TIT2\x00\x00\x00\x08\x00\x00\x03Welcome'
+			b'COMM\x00\x00\x00\x05\x00\x00\x07eng\x00'
+			b'TALB\x00\x00\x00\x0a\x00\x00\x03Americana'
+		)
+		byte_array = b'ID3\x04\x00\x00\x00\x00\x00\x7f' + frames + b'\x00' * (0x7f - len(frames))
+
+		with self.assertRaises(ID3Error):
+			ID3.from_byte_array(byte_array)
+
+		id3 = ID3.from_byte_array(byte_array, salvage=True)
+
+		self.assertEqual(['TPE1', 'TIT2', 'TALB'], [f.name for f in id3.frames])
+		self.assertEqual('Welcome', id3.find_frame_by_name('TIT2').text)
+		self.assertEqual([(35, 44), (62, 77)], id3.damaged_ranges)
+
+		path = self.make_mp3(byte_array)
+		self.assertEqual(3, len(ID3.from_file(path, salvage=True).frames))
+
+	def test_salvage_is_linear_on_adversarial_input(self):
+		# Every position looks like the start of a frame name, but no frame size fits into the tag.
+		frames = b'TIT2\x7f\x7f\x7f\x7f' * 50000 + b'TALB\x00\x00\x00\x0a\x00\x00\x03Americana'
+		byte_array = b'ID3\x04\x00' + b'\x00' + pack_int(len(frames), base=SYNCHSAFE_BASE, min_bytes=4) + frames
+
+		id3 = ID3.from_byte_array(byte_array, salvage=True)
+
+		self.assertEqual(['TALB'], [f.name for f in id3.frames])
+		self.assertEqual([(10, 400010)], id3.damaged_ranges)
+
+	def test_serialized_buffers_make_up_serialized_tag(self):
+		id3 = ID3.from_byte_array(TestID3.test_average_case_data)
+		id3.header.flags.has_footer = True
+
+		self.assertEqual(id3.serialize(min_length=2000), b''.join(id3.serialize_buffers(min_length=2000)))
+
+	def test_pickling(self):
+		id3 = ID3.from_byte_array(TestID3.test_average_case_data)
+		id3.initial_path = '/music/americana/01.mp3'
+		id3.find_frame_by_name('TIT2').text = 'Welcome'
+
+		id3 = pickle.loads(pickle.dumps(id3))
+
+		self.assertEqual('/music/americana/01.mp3', id3.initial_path)
+		self.assertEqual('Welcome', id3.find_frame_by_name('TIT2').text)
+		self.assertEqual('The Offspring', id3.find_frame_by_name('TPE1').text)
+
+	def test_pickling_does_not_change_the_tag(self):
+		byte_array = b'ID3\x03\x00\x00\x00\x00\x01\x6aTPE1\x00\x00\x00\x0c\x00\x00\x00AB\x00garbage\x00' + b'\x00' * 212
+		original = ID3.from_byte_array(byte_array)
+		original.find_frame_by_name('TPE1').header.body_size = 40
+
+		id3 = pickle.loads(pickle.dumps(pickle.loads(pickle.dumps(original))))
+
+		self.assertEqual(234, original.header.tag_size)
+		self.assertEqual(40, original.find_frame_by_name('TPE1').header.body_size)
+
+		self.assertEqual(3, id3.header.major_version)
+		self.assertEqual(234, id3.header.tag_size)
+		self.assertEqual(['AB'], id3.find_frame_by_name('TPE1').texts)
+		self.assertEqual(3, id3.find_frame_by_name('TPE1').header.tag_version)
+
+	def test_pickling_frames_of_other_versions(self):
+		id3 = ID3.from_byte_array(b'ID3\x03\x00\x00\x00\x00\x00\x00')
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'x' * 300))
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'The Offspring'))
+
+		id3 = pickle.loads(pickle.dumps(id3))
+		self.assertEqual(['TIT2', 'TPE1'], [f.name for f in id3.frames])
+		self.assertEqual('x' * 300, id3.find_frame_by_name('TIT2').text)
+
+		frame = ID3Frame.from_byte_array(b'TPE1\x00\x00\x00\xc8\x00\x00\x03' + b'y' * 199, tag_version=3)
+		id3 = ID3.from_scratch()
+		id3.add_frame(frame)
+
+		id3 = pickle.loads(pickle.dumps(id3))
+		self.assertEqual('y' * 199, id3.find_frame_by_name('TPE1').text)
+
+	def test_unpickled_tag_is_parsed_once_by_concurrent_threads(self):
+		pickled = pickle.dumps(ID3.from_byte_array(TestID3.test_average_case_data))
+
+		for _ in range(20):
+			id3 = pickle.loads(pickled)
+			barrier = threading.Barrier(4)
+			results = queue.Queue()
+
+			def count_frames():
+				barrier.wait()
+				results.put(len(id3.frames))
+
+			threads = [threading.Thread(target=count_frames) for _ in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+			self.assertEqual([21] * 4, [results.get_nowait() for _ in range(4)])
+
+	def test_pickle_contains_serialized_tag(self):
+		id3 = ID3.from_byte_array(TestID3.test_average_case_data)
+		self.assertLess(len(pickle.dumps(id3)), len(TestID3.test_average_case_data) + 200)
+
+	def test_unpickled_tag_is_parsed_lazily(self):
+		id3 = pickle.loads(pickle.dumps(ID3.from_byte_array(TestID3.test_average_case_data)))
+		self.assertNotIn('body', id3.__dict__)
+
+		id3 = pickle.loads(pickle.dumps(id3))
+		self.verify_average_case_tag(id3)
+
 	def make_mp3_with_tag_and_padding(self):
 		id3 = self.make_id3()
 		serialized_tag = id3.serialize(min_length=60)
@@ -180,6 +528,438 @@ class TestID3(unittest.TestCase):
 		f.close()
 
 
+class CountingStream(io.BytesIO):
+
+	def __init__(self, byte_array, seekable=True):
+		super().__init__(byte_array)
+		self.is_seekable = seekable
+		self.sizes = []
+
+	@property
+	def reads(self):
+		return len(self.sizes)
+
+	def seekable(self):
+		return self.is_seekable
+
+	def read(self, n=-1):
+		self.sizes.append(n)
+		return super().read(n)
+
+
+class TrickleStream(io.BytesIO):
+
+	# Returns at most max_read bytes per read, like a pipe.
+
+	def __init__(self, byte_array, max_read):
+		super().__init__(byte_array)
+		self.max_read = max_read
+
+	def seekable(self):
+		return False
+
+	def read(self, n=-1):
+		if n is None or n < 0 or n > self.max_read:
+			n = self.max_read
+
+		return super().read(n)
+
+
+class TestID3Columns(unittest.TestCase):
+
+	def test_columns_of_files_with_and_without_tag(self):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3PlayCounterFrame.from_scratch(30))
+
+		paths = [self.make_file(TestID3.test_average_case_data), self.make_file(b''), self.make_file(id3.serialize())]
+		columns = ID3Columns.from_files(paths, ['TIT2', 'TPE1', 'PCNT'])
+
+		self.assertEqual(3, len(columns))
+		self.assertEqual(paths, columns['path'])
+		self.assertEqual([0x31f, 0, 14], list(columns['tag_size']))
+		self.assertEqual([4, 0, 4], list(columns['version']))
+		self.assertEqual(['Why Don\'t You Get A Job?', None, None], columns['TIT2'])
+		self.assertEqual(['The Offspring', None, None], columns['TPE1'])
+		self.assertEqual([None, None, 30], columns['PCNT'])
+
+	def test_truncated_extended_header(self):
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(b'ID3\x04\x00\x40\x00\x00\x00\x00')
+
+		header, values = ID3Columns.read_file(path, ['TIT2'])
+		self.assertTrue(header.flags.has_extended_header)
+		self.assertEqual({}, values)
+
+		self.assertEqual(0, scan_file(path, ['TIT2'])['tag_size'])
+
+	def make_file(self, serialized_tag):
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(serialized_tag + b'\xff\xf0...the.mp3.file...')
+
+		return path
+
+
+class TestIterFrameSpans(unittest.TestCase):
+
+	def test_frame_spans(self):
+		byte_array = b'TPE1\x00\x00\x00\x03\x00\x00\x03ABPCNT\x00\x00\x00\x05\x00\x01\x00\x00\x00\x01\x1e\x00\x00\x00'
+		frame_spans = list(iter_frame_spans(byte_array, tag_version=4))
+
+		self.assertEqual(['TPE1', 'PCNT'], [f.name for f in frame_spans])
+		self.assertEqual((0, 10, 13), frame_spans[0][1:4])
+		self.assertEqual((13, 27, 28), frame_spans[1][1:4])
+		self.assertEqual(b'\x1e', get_frame_body(byte_array, frame_spans[1]))
+
+class TestID3Limits(unittest.TestCase):
+
+	def test_tag_size_is_checked_before_reading(self):
+		class UnreadableStream:
+			def __init__(self):
+				self.reads = [b'ID3\x04\x00\x00\x7f\x7f\x7f\x7f']
+
+			def read(self, n):
+				return self.reads.pop(0)
+
+		with self.assertRaises(ID3LimitExceededError):
+			ID3.from_input_stream(UnreadableStream(), limits=ID3Limits(max_tag_size=1024 * 1024))
+
+	def test_max_frames(self):
+		ID3.from_byte_array(TestID3.test_average_case_data, limits=ID3Limits(max_frames=21))
+
+		with self.assertRaises(ID3LimitExceededError):
+			ID3.from_byte_array(TestID3.test_average_case_data, limits=ID3Limits(max_frames=20))
+
+	def test_max_frame_size(self):
+		with self.assertRaises(ID3LimitExceededError):
+			ID3.from_byte_array(TestID3.test_average_case_data, limits=ID3Limits(max_frame_size=0x80))
+
+	def test_max_decompressed_size(self):
+		byte_array = b'TPE1\x00\x00\x00\x18\x00\x03\x7f\x7f\x7f\x7f\x01\xff\x00\xfeR\x00\xe9\x00n\x00a\x00u\x00l\x00t\x00\x00\x00'
+
+		with self.assertRaises(ID3LimitExceededError):
+			ID3Frame.from_byte_array(byte_array, limits=ID3Limits(max_decompressed_size=1024))
+
+	def test_limit_error_is_not_swallowed_when_loading_a_file(self):
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(TestID3.test_average_case_data)
+
+		with warnings.catch_warnings(record=True) as caught:
+			warnings.simplefilter('always', ResourceWarning)
+
+			with self.assertRaises(ID3LimitExceededError):
+				ID3.from_file(path, limits=ID3Limits(max_tag_size=100))
+
+			gc.collect()
+
+		self.assertEqual([], [w for w in caught if issubclass(w.category, ResourceWarning)])
+
+class TestScan(unittest.TestCase):
+
+	def test_scan_directory_tree(self):
+		directory = tempfile.mkdtemp()
+		os.makedirs(os.path.join(directory, 'Americana'))
+
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+
+		with open(os.path.join(directory, 'Americana', '01.mp3'), 'wb') as f:
+			f.write(id3.serialize() + b'\xff\xf0...the.mp3.file...')
+
+		with open(os.path.join(directory, 'cover.jpg'), 'wb') as f:
+			f.write(b'....the...picture....')
+
+		for jobs in (1, 2):
+			output = io.StringIO()
+			statistics = io.StringIO()
+			scan(directory, ['TIT2', 'TPE1'], jobs=jobs, jsonl=True, output=output, statistics=statistics)
+
+			records = [json.loads(line) for line in output.getvalue().splitlines()]
+
+			self.assertEqual(os.path.join(directory, 'cover.jpg'), records[0]['path'])
+			self.assertIsNone(records[0]['version'])
+			self.assertEqual(os.path.join(directory, 'Americana', '01.mp3'), records[1]['path'])
+			self.assertEqual({'TIT2': 'Welcome', 'TPE1': None}, records[1]['frames'])
+			self.assertIn('Scanned 2 files with 1 tags', statistics.getvalue())
+
+	def test_verify_directory_tree(self):
+		directory = tempfile.mkdtemp()
+
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+		id3.header.flags.has_extended_header = True
+		id3.extended_header = ID3ExtendedHeader.from_scratch()
+		id3.extended_header.has_crc = True
+
+		for name in ('01.mp3', '02.mp3'):
+			with open(os.path.join(directory, name), 'wb') as f:
+				f.write(id3.serialize() + b'\xff\xf0...the.mp3.file...')
+
+		with open(os.path.join(directory, '02.mp3'), 'r+b') as f:
+			f.seek(30)
+			f.write(b'X')
+
+		output = io.StringIO()
+		statistics = io.StringIO()
+
+		self.assertEqual(1, verify(directory, jobs=2, output=output, statistics=statistics))
+		self.assertEqual(
+			['%s\tok' % os.path.join(directory, '01.mp3'), '%s\tcorrupt' % os.path.join(directory, '02.mp3')],
+			output.getvalue().splitlines()
+		)
+		self.assertIn('Verified 2 of 2 files', statistics.getvalue())
+
+class TestFind(unittest.TestCase):
+
+	def test_find_by_predicates(self):
+		directory = tempfile.mkdtemp()
+		paths = [
+			self.write_mp3(directory, '01.mp3', 'The Offspring', 'Punk Rock', 10),
+			self.write_mp3(directory, '02.mp3', 'The Offspring', 'Alternative', 3),
+			self.write_mp3(directory, '03.mp3', 'Green Day', 'Punk Rock', 10),
+			os.path.join(directory, 'missing.mp3')
+		]
+
+		for jobs in (1, 2):
+			self.assertEqual(paths[0:2], list(find(paths, {'TPE1': 'The Offspring'}, jobs=jobs)))
+			self.assertEqual(
+				[paths[0]],
+				list(find(paths, {'TPE1': 'The Offspring', 'TCON': re.compile('punk', re.IGNORECASE)}, jobs=jobs))
+			)
+			self.assertEqual([paths[0], paths[2]], list(find(paths, {'PCNT': lambda count: count > 5}, jobs=jobs)))
+			self.assertEqual([], list(find(paths, {'TALB': 'Americana'}, jobs=jobs)))
+
+	def test_find_stops_reading_when_result_is_known(self):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'The Offspring'))
+		id3.add_frame(ID3TextFrame.from_scratch('TCON', 'Punk Rock'))
+
+		# The bytes after the first frame are not a frame and would fail parsing.
+		byte_array = id3.serialize()
+		byte_array = byte_array[0:35] + b'\xff' * (len(byte_array) - 35)
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(byte_array)
+
+		self.assertEqual([path], list(find([path], {'TPE1': 'The Offspring'})))
+		self.assertEqual([], list(find([path], {'TPE1': 'Green Day', 'TCON': 'Punk Rock'})))
+
+	def write_mp3(self, directory, name, artist, genre, play_counter):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', artist))
+		id3.add_frame(ID3TextFrame.from_scratch('TCON', genre))
+		id3.add_frame(ID3PlayCounterFrame.from_scratch(play_counter))
+
+		path = os.path.join(directory, name)
+		with open(path, 'wb') as f:
+			f.write(id3.serialize() + b'\xff\xf0...the.mp3.file...')
+
+		return path
+
+class TestCompact(unittest.TestCase):
+
+	def test_compact_file(self):
+		path = self.make_mp3()
+		inode = os.stat(path).st_ino
+
+		record = compact_file(path, max_padding=100)
+		self.assertEqual(2, record['dropped_frames'])
+		self.assertGreater(record['reclaimed'], 5000)
+		self.assertNotEqual(inode, os.stat(path).st_ino)
+
+		id3 = ID3.from_file(path)
+		self.assertEqual(['TPE1', 'APIC', 'APIC'], [f.name for f in id3.frames])
+		self.assertEqual(
+			[ID3PictureTypes.FRONT_COVER, ID3PictureTypes.BACK_COVER], [f.picture_type for f in id3.find_frames_by_name('APIC')]
+		)
+		self.assertEqual('The Offspring', id3.find_frame_by_name('TPE1').text)
+		self.assertEqual(b'\x03', id3.find_frame_by_name('TPE1').serialize()[10:11])
+		self.assertEqual(id3.serialized_size() + 100, id3.header.tag_size + 10)
+
+		with open(path, 'rb') as f:
+			self.assertEqual(b'\xff\xf0...the.mp3.file...', f.read()[id3.header.tag_size + 10:])
+
+		self.assertEqual(0, compact_file(path, max_padding=100)['reclaimed'])
+
+	def test_compact_directory(self):
+		directory = tempfile.mkdtemp()
+		paths = [self.make_mp3(directory), os.path.join(directory, 'missing.mp3')]
+
+		with open(os.path.join(directory, 'cover.jpg'), 'wb') as f:
+			f.write(b'....the...picture....')
+		paths.append(os.path.join(directory, 'cover.jpg'))
+
+		output = io.StringIO()
+		statistics = io.StringIO()
+		reclaimed = compact(paths, jobs=2, output=output, statistics=statistics, max_padding=0)
+
+		records = [json.loads(line) for line in output.getvalue().splitlines()]
+
+		self.assertEqual(paths[0:2], [r['path'] for r in records])
+		self.assertEqual(reclaimed, records[0]['reclaimed'])
+		self.assertIn('error', records[1])
+		self.assertIn('Compacted 3 files', statistics.getvalue())
+
+	def test_compact_directory_with_malformed_frame(self):
+		directory = tempfile.mkdtemp()
+		paths = [os.path.join(directory, '01.mp3'), self.make_mp3(directory)]
+
+		with open(paths[0], 'wb') as f:
+			f.write(b'ID3\x04\x00\x00\x00\x00\x00\x0eCOMM\x00\x00\x00\x04\x00\x00\x00deu' + b'\xff\xf0...the.mp3.file...')
+
+		output = io.StringIO()
+		compact(paths, jobs=2, output=output, statistics=io.StringIO(), max_padding=0)
+
+		records = [json.loads(line) for line in output.getvalue().splitlines()]
+
+		self.assertEqual(paths, [r['path'] for r in records])
+		self.assertIn('error', records[0])
+		self.assertGreater(records[1]['reclaimed'], 0)
+
+	def make_mp3(self, directory=None):
+		utf16_body = b'\x01' + 'The Offspring'.encode('utf-16') + b'\x00\x00'
+
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3Frame.from_byte_array(b'TPE1\x00\x00\x00' + bytes([len(utf16_body)]) + b'\x00\x00' + utf16_body))
+		id3.add_frame(ID3UnknownFrame.from_scratch('PRIV', b'WM/Provider\x00' + b'.' * 100))
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', b'\x89PNG' * 100))
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.BACK_COVER, '', b'\x89PNG' * 100))
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', b'\x89PNG' * 100))
+
+		path = tempfile.mkstemp(dir=directory)[1]
+		with open(path, 'wb') as f:
+			f.write(id3.serialize(min_length=6000) + b'\xff\xf0...the.mp3.file...')
+
+		return path
+
+class TestID3Manifest(unittest.TestCase):
+
+	def test_rescan(self):
+		directory = tempfile.mkdtemp()
+		manifest_path = os.path.join(tempfile.mkdtemp(), 'manifest.jsonl')
+
+		self.write_mp3(os.path.join(directory, '01.mp3'), 'Welcome')
+		self.write_mp3(os.path.join(directory, '02.mp3'), 'Have You Ever')
+		self.write_mp3(os.path.join(directory, '03.mp3'), 'Staring At The Sun')
+
+		manifest = ID3Manifest.from_scratch()
+		events = list(manifest.scan(directory))
+
+		self.assertEqual(['added'] * 3, [e.kind for e in events])
+		self.assertEqual('Welcome', events[0].id3.find_frame_by_name('TIT2').text)
+		manifest.to_file(manifest_path)
+
+		self.write_mp3(os.path.join(directory, '01.mp3'), 'Pretty Fly')
+		self.write_mp3(os.path.join(directory, '02.mp3'), 'Have You Ever', audio=b'\xff\xf0...other.audio...')
+		os.remove(os.path.join(directory, '03.mp3'))
+		self.write_mp3(os.path.join(directory, '04.mp3'), 'The Kids Aren\'t Alright')
+
+		manifest = ID3Manifest.from_file(manifest_path)
+		events = list(manifest.scan(directory))
+
+		self.assertEqual(
+			[('changed', '01.mp3'), ('added', '04.mp3'), ('removed', '03.mp3')],
+			[(e.kind, os.path.basename(e.path)) for e in events]
+		)
+		self.assertEqual(3, len(manifest))
+		self.assertEqual([], list(manifest.scan(directory)))
+
+	def test_scan_continues_after_damaged_tag(self):
+		directory = tempfile.mkdtemp()
+		manifest = ID3Manifest.from_scratch()
+
+		self.write_mp3(os.path.join(directory, '01.mp3'), 'Welcome')
+		list(manifest.scan(directory))
+		os.remove(os.path.join(directory, '01.mp3'))
+
+		with open(os.path.join(directory, '02.mp3'), 'wb') as f:
+			f.write(b'ID3\x04\x00\x00\x00\x00\x00\x0fT\xc4T2\x00\x00\x00\x05\x00\x00\x03Ab\x00\x00')
+		self.write_mp3(os.path.join(directory, '03.mp3'), 'Have You Ever')
+
+		events = list(manifest.scan(directory))
+
+		self.assertEqual(
+			[('added', '02.mp3'), ('added', '03.mp3'), ('removed', '01.mp3')],
+			[(e.kind, os.path.basename(e.path)) for e in events]
+		)
+		self.assertIsNone(manifest.entries[os.path.join(directory, '02.mp3')].tag_hash)
+
+	def write_mp3(self, path, title, audio=b'\xff\xf0...the.mp3.file...'):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TIT2', title))
+
+		with open(path, 'wb') as f:
+			f.write(id3.serialize() + audio)
+
+class TestID3Watcher(unittest.TestCase):
+
+	write_mp3 = TestID3Manifest.write_mp3
+
+	def test_diff_tags(self):
+		old_id3 = ID3.from_scratch()
+		old_id3.add_frame(ID3TextFrame.from_scratch('TIT2', 'Welcome'))
+		old_id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'The Offspring'))
+		old_id3.add_frame(ID3PlayCounterFrame.from_scratch(10))
+
+		new_id3 = ID3.from_byte_array(old_id3.serialize())
+		new_id3.find_frame_by_name('TIT2').text = 'Pretty Fly'
+		new_id3.frames.remove(new_id3.find_frame_by_name('PCNT'))
+		new_id3.add_frame(ID3TextFrame.from_scratch('TALB', 'Americana'))
+
+		diff = diff_tags(old_id3, new_id3)
+
+		self.assertEqual(['TIT2', 'PCNT', 'TALB'], list(diff))
+		self.assertEqual(['Welcome'], [f.text for f in diff['TIT2'][0]])
+		self.assertEqual(['Pretty Fly'], [f.text for f in diff['TIT2'][1]])
+		self.assertEqual([], diff['PCNT'][1])
+		self.assertEqual([], diff['TALB'][0])
+		self.assertEqual(['TIT2', 'TPE1', 'PCNT'], list(diff_tags(old_id3, None)))
+
+	def test_watch_inotify(self):
+		if not ID3Inotify.is_available():
+			self.skipTest('inotify is not available')
+
+		self.verify_watch(use_inotify=True)
+
+	def test_watch_polling(self):
+		self.verify_watch(use_inotify=False)
+
+	def verify_watch(self, use_inotify):
+		directory = tempfile.mkdtemp()
+		path = os.path.join(directory, 'album', '01.mp3')
+		os.mkdir(os.path.dirname(path))
+
+		changes = queue.Queue()
+		watcher = ID3Watcher(
+			directory, lambda p, i, d: changes.put((p, i, d)), debounce=0.05, poll_interval=0.05, use_inotify=use_inotify
+		)
+		watcher.start()
+
+		try:
+			self.write_mp3(path, 'Welcome')
+			changed_path, id3, diff = changes.get(timeout=5)
+
+			self.assertEqual(path, changed_path)
+			self.assertEqual('Welcome', id3.find_frame_by_name('TIT2').text)
+			self.assertEqual(['TIT2'], list(diff))
+
+			time.sleep(0.1)
+			self.write_mp3(path, 'Pretty Fly')
+			_, id3, diff = changes.get(timeout=5)
+
+			self.assertEqual('Pretty Fly', id3.find_frame_by_name('TIT2').text)
+			self.assertEqual(['Welcome'], [f.text for f in diff['TIT2'][0]])
+
+			os.remove(path)
+			_, id3, diff = changes.get(timeout=5)
+
+			self.assertIsNone(id3)
+			self.assertEqual([], diff['TIT2'][1])
+		finally:
+			watcher.stop()
+
 class TestID3Frame(unittest.TestCase):
 
 	def test_all_flags_unset(self):
@@ -240,6 +1020,47 @@ class TestID3Frame(unittest.TestCase):
 		frame = ID3Frame.from_byte_array(serialized_frame)
 		self.assertEqual(frame_data, frame.raw_bytes)
 
+	def test_unsync_escapes_false_syncs(self):
+		byte_array = b'\xff\x00\xff\xe0\xff\xe1\xff\xff\xff'
+
+		self.assertEqual(b'\xff\x00\x00\xff\xe0\xff\x00\xe1\xff\x00\xff\x00\xff', unsync(byte_array))
+
+	def test_serialized_size(self):
+		frame = ID3UnknownFrame.from_scratch('PRIV', b'A\xff\xf0\xff\xf0')
+		frame.header.format_flags.unsynced = True
+
+		self.assertEqual(17, frame.serialized_size())
+		self.assertEqual(17, len(frame.serialize()))
+
+	def test_unmodified_frame_is_serialized_from_cache(self):
+		byte_array = b'TPE1\x00\x00\x00\x09\x00\x00\x00R\xe9nault\x00'
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertFalse(frame.dirty)
+		self.assertEqual(byte_array, frame.serialize())
+
+	def test_modified_frame_is_serialized_again(self):
+		frame = ID3Frame.from_byte_array(b'TPE1\x00\x00\x00\x09\x00\x00\x00R\xe9nault\x00')
+		frame.text = 'Citroen'
+
+		self.assertTrue(frame.dirty)
+		self.assertEqual(b'TPE1\x00\x00\x00\x09\x00\x00\x03Citroen\x00', frame.serialize())
+		self.assertFalse(frame.dirty)
+
+	def test_changed_unsynchronisation_flag_invalidates_cache(self):
+		frame = ID3Frame.from_byte_array(b'PRIV\x00\x00\x00\x03\x00\x00A\xff\xf0')
+		frame.header.format_flags.unsynced = True
+
+		self.assertEqual(b'PRIV\x00\x00\x00\x04\x00\x02A\xff\x00\xf0', frame.serialize())
+
+	def test_pickling(self):
+		frame = ID3PopularimeterFrame.from_scratch('user@localhost', 128, 30)
+		frame = pickle.loads(pickle.dumps(frame))
+
+		self.assertIsInstance(frame, ID3PopularimeterFrame)
+		self.assertEqual(128, frame.rating)
+		self.assertFalse(frame.dirty)
+
 	def test_frame_with_only_a_single_byte(self):
 		frame = ID3Frame.from_byte_array(b'TRCK\x00\x00\x00\x01\x00\x00\x00')
 		self.assertEqual('', frame.text)
@@ -255,6 +1076,66 @@ class TestID3Frame(unittest.TestCase):
 			ID3Frame.from_byte_array(byte_array)
 
 
+class TestRegisterImplementation(unittest.TestCase):
+
+	def test_registered_implementation_is_used_for_parsing(self):
+		class ID3GroupingFrame(ID3UnknownFrame):
+
+			def from_byte_array(header, byte_array):
+				return ID3GroupingFrame(header, byte_array)
+
+			def can_handle(name):
+				return name == 'GRP1'
+
+		implementations = ID3Frame.id3_frame_implementations
+		ID3Frame.register_implementation(ID3GroupingFrame)
+
+		try:
+			frame = ID3Frame.from_byte_array(b'GRP1\x00\x00\x00\x03\x00\x00\x03Pop')
+			self.assertIsInstance(frame, ID3GroupingFrame)
+			self.assertNotIn(ID3GroupingFrame, implementations)
+		finally:
+			ID3Frame.id3_frame_implementations = implementations
+
+	def test_registered_implementation_gets_parse_options(self):
+		class ID3GroupingFrame(ID3UnknownFrame):
+
+			parse_options = ('string_pool',)
+
+			def from_byte_array(header, byte_array, string_pool=None):
+				frame = ID3GroupingFrame(header, byte_array)
+				frame.string_pool = string_pool
+				return frame
+
+			def can_handle(name):
+				return name == 'GRP1'
+
+		implementations = ID3Frame.id3_frame_implementations
+		ID3Frame.register_implementation(ID3GroupingFrame)
+
+		try:
+			string_pool = ID3StringPool()
+			frame = ID3Frame.from_byte_array(b'GRP1\x00\x00\x00\x03\x00\x00\x03Pop', string_pool=string_pool, limits=ID3Limits())
+			self.assertIs(string_pool, frame.string_pool)
+		finally:
+			ID3Frame.id3_frame_implementations = implementations
+
+	def test_appended_implementation_is_used_for_parsing(self):
+		class ID3GroupingFrame(ID3UnknownFrame):
+
+			def from_byte_array(header, byte_array):
+				return ID3GroupingFrame(header, byte_array)
+
+			def can_handle(name):
+				return name == 'GRP1'
+
+		ID3Frame.id3_frame_implementations.append(ID3GroupingFrame)
+
+		try:
+			self.assertIsInstance(ID3Frame.from_byte_array(b'GRP1\x00\x00\x00\x03\x00\x00\x03Pop'), ID3GroupingFrame)
+		finally:
+			ID3Frame.id3_frame_implementations.remove(ID3GroupingFrame)
+
 class TestID3TextFrame(unittest.TestCase):
 
 	def test_utf8_encoded_frame(self):
@@ -292,6 +1173,35 @@ class TestID3TextFrame(unittest.TestCase):
 
 		self.assertEqual('Rénault', frame.text)
 
+	def test_multiple_values(self):
+		byte_array = b'TPE1\x00\x00\x00\x1f\x00\x00\x03The Offspring\x00Die Toten Hosen\x00'
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertEqual(['The Offspring', 'Die Toten Hosen'], frame.texts)
+		self.assertEqual('The Offspring', frame.text)
+
+	def test_multiple_utf16_encoded_values(self):
+		byte_array = b'TPE1\x00\x00\x00\x13\x00\x00\x01\xff\xfeA\x00b\x00\x00\x00\xff\xfeC\x00d\x00\x00\x00'
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertEqual(['Ab', 'Cd'], frame.texts)
+
+	def test_multiple_utf16_encoded_values_with_different_byte_orders(self):
+		byte_array = b'TPE1\x00\x00\x00\x13\x00\x00\x01\xff\xfeA\x00b\x00\x00\x00\xfe\xff\x00C\x00d\x00\x00'
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertEqual(['Ab', 'Cd'], frame.texts)
+
+	def test_multiple_values_are_not_split_in_version_3(self):
+		byte_array = b'TPE1\x00\x00\x00\x1f\x00\x00\x03The Offspring\x00Die Toten Hosen\x00'
+		frame = ID3Frame.from_byte_array(byte_array, tag_version=3)
+
+		self.assertEqual(['The Offspring'], frame.texts)
+
+	def test_serialization_of_multiple_values(self):
+		frame = ID3TextFrame.from_scratch('TPE1', ['The Offspring', 'Die Toten Hosen'])
+		self.assertEqual(b'TPE1\x00\x00\x00\x1f\x00\x00\x03The Offspring\x00Die Toten Hosen\x00', frame.serialize())
+
 	def test_serialization(self):
 		frame = ID3TextFrame.from_scratch('TIT2', 'Caught Me Thinking')
 		self.assertEqual(b'TIT2\x00\x00\x00\x14\x00\x00\x03Caught Me Thinking\x00', frame.serialize())
@@ -300,6 +1210,58 @@ class TestID3TextFrame(unittest.TestCase):
 		with self.assertRaises(ValueError):
 			ID3TextFrame.from_scratch('ABCD', 'Caught Me Thinking')
 
+	def test_pickled_values_keep_their_frame(self):
+		texts = pickle.loads(pickle.dumps(ID3TextFrame.from_scratch('TPE1', ['The Offspring']).texts))
+		self.assertFalse(texts.frame.dirty)
+
+		texts.append('Die Toten Hosen')
+		self.assertTrue(texts.frame.dirty)
+
+	def test_changing_values_in_place_marks_frame_dirty(self):
+		frame = ID3Frame.from_byte_array(b'TPE1\x00\x00\x00\x0f\x00\x00\x03The Offspring\x00')
+		self.assertFalse(frame.dirty)
+
+		frame.texts.append('Die Toten Hosen')
+		self.assertTrue(frame.dirty)
+		self.assertEqual(b'TPE1\x00\x00\x00\x1f\x00\x00\x03The Offspring\x00Die Toten Hosen\x00', frame.serialize())
+
+		self.assertFalse(frame.dirty)
+		frame.texts[0] = 'Tocotronic'
+		self.assertTrue(frame.dirty)
+		self.assertEqual(b'TPE1\x00\x00\x00\x1c\x00\x00\x03Tocotronic\x00Die Toten Hosen\x00', frame.serialize())
+
+
+class TestID3StringPool(unittest.TestCase):
+
+	def test_equal_values_share_one_string(self):
+		string_pool = ID3StringPool()
+
+		first_frame = ID3Frame.from_byte_array(b'TPE1\x00\x00\x00\x0f\x00\x00\x03The Offspring\x00', string_pool=string_pool)
+		second_frame = ID3Frame.from_byte_array(b'TPE2\x00\x00\x00\x0f\x00\x00\x03The Offspring\x00', string_pool=string_pool)
+
+		self.assertEqual('The Offspring', second_frame.text)
+		self.assertIs(first_frame.text, second_frame.text)
+		self.assertIsNot(first_frame.texts, second_frame.texts)
+
+		self.assertEqual(1, string_pool.hits)
+		self.assertEqual(1, string_pool.misses)
+		self.assertEqual(0.5, string_pool.hit_rate)
+		self.assertGreater(string_pool.bytes_saved, 0)
+
+	def test_pool_is_bounded(self):
+		string_pool = ID3StringPool(max_entries=2)
+
+		for text in (b'A', b'B', b'C'):
+			ID3Frame.from_byte_array(b'TPE1\x00\x00\x00\x02\x00\x00\x03' + text, string_pool=string_pool)
+
+		self.assertEqual(2, len(string_pool))
+
+	def test_tag_parsed_with_pool(self):
+		string_pool = ID3StringPool()
+
+		ID3.from_byte_array(TestID3.test_average_case_data, string_pool=string_pool)
+
+		self.assertEqual(2, string_pool.hits)
 
 class TestID3CommentFrame(unittest.TestCase):
 
@@ -373,6 +1335,136 @@ class TestID3PlayCounterFrame(unittest.TestCase):
 		self.assertEqual(9999999999, frame.play_counter)
 
 
+class TestID3SynchronizedLyricsFrame(unittest.TestCase):
+
+	def test_parse_utf16_lyrics(self):
+		byte_array = (
+			b'SYLT\x00\x00\x00\x2f\x00\x00\x01eng\x02\x01\xff\xfeL\x00\x00\x00'
+			b'\xff\xfeO\x00n\x00e\x00\x00\x00\x00\x00\x03\xe8'
+			b'\xff\xfeT\x00w\x00o\x00\x00\x00\x00\x00\x07\xd0'
+		)
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertEqual('eng', frame.language)
+		self.assertEqual('L', frame.description)
+		self.assertEqual(ID3SynchronizedLyricsFrame.TIMESTAMP_MILLISECONDS, frame.timestamp_format)
+		self.assertEqual([(1000, 'One'), (2000, 'Two')], frame.entries)
+		self.assertEqual('I', frame.timestamps.typecode)
+
+	def test_text_at(self):
+		frame = ID3SynchronizedLyricsFrame.from_scratch('eng', '', [(2000, 'Two'), (1000, 'One'), (3000, 'Three')])
+
+		self.assertIsNone(frame.text_at(999))
+		self.assertEqual('One', frame.text_at(1000))
+		self.assertEqual('Two', frame.text_at(2999))
+		self.assertEqual('Three', frame.text_at(10 ** 9))
+
+	def test_serialize(self):
+		frame = ID3SynchronizedLyricsFrame.from_scratch('eng', 'Lyrics', [(0, 'Why'), (1500, 'Don\'t')])
+		frame = ID3Frame.from_byte_array(frame.serialize())
+
+		self.assertEqual('Lyrics', frame.description)
+		self.assertEqual([(0, 'Why'), (1500, 'Don\'t')], frame.entries)
+
+	def test_changing_entries_in_place_marks_frame_dirty(self):
+		serialized_frame = ID3SynchronizedLyricsFrame.from_scratch('eng', '', [(0, 'Why'), (1500, 'Don\'t')]).serialize()
+
+		frame = ID3Frame.from_byte_array(serialized_frame)
+		frame.texts[0] = 'How'
+		self.assertTrue(frame.dirty)
+		self.assertEqual([(0, 'How'), (1500, 'Don\'t')], ID3Frame.from_byte_array(frame.serialize()).entries)
+
+		frame = ID3Frame.from_byte_array(serialized_frame)
+		frame.timestamps[1] = 2000
+		self.assertTrue(frame.dirty)
+		self.assertEqual([(0, 'Why'), (2000, 'Don\'t')], ID3Frame.from_byte_array(frame.serialize()).entries)
+
+
+class TestID3ChapterFrame(unittest.TestCase):
+
+	def test_serialize_chapters_and_table_of_contents(self):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TableOfContentsFrame.from_scratch('toc', ['chp1', 'chp0']))
+		id3.add_frame(ID3ChapterFrame.from_scratch('chp1', 60000, 120000, [ID3TextFrame.from_scratch('TIT2', 'News')]))
+		id3.add_frame(ID3ChapterFrame.from_scratch('chp0', 0, 60000, [ID3TextFrame.from_scratch('TIT2', 'Intro')]))
+
+		id3 = ID3.from_byte_array(id3.serialize())
+		toc = id3.find_frame_by_name('CTOC')
+
+		self.assertEqual(['chp1', 'chp0'], toc.child_element_ids)
+		self.assertTrue(toc.top_level)
+		self.assertTrue(toc.ordered)
+		self.assertEqual(['News', 'Intro'], [chapter.title for chapter in id3.find_frames_by_name('CHAP')])
+		self.assertEqual(ID3ChapterFrame.UNUSED_OFFSET, id3.find_frames_by_name('CHAP')[0].start_offset)
+
+		index = ID3ChapterIndex.from_id3(id3)
+
+		self.assertEqual(2, len(index))
+		self.assertEqual('Intro', index.chapter_at(0).title)
+		self.assertEqual('News', index.chapter_at(60000).title)
+		self.assertIsNone(index.chapter_at(120000))
+
+	def test_parse_chapter(self):
+		byte_array = (
+			b'CHAP\x00\x00\x00\x25\x00\x00chp\x00\x00\x00\x00\x00\x00\x00\x13\x88\xff\xff\xff\xff\xff\xff\xff\xff'
+			b'TIT2\x00\x00\x00\x07\x00\x00\x03Intro\x00'
+		)
+		frame = ID3Frame.from_byte_array(byte_array)
+
+		self.assertEqual('chp', frame.element_id)
+		self.assertEqual((0, 5000), (frame.start_time, frame.end_time))
+		self.assertEqual('Intro', frame.title)
+		self.assertEqual(byte_array, frame.serialize())
+
+
+	def test_changing_sub_frames_marks_chapter_dirty(self):
+		byte_array = (
+			b'CHAP\x00\x00\x00\x25\x00\x00chp\x00\x00\x00\x00\x00\x00\x00\x13\x88\xff\xff\xff\xff\xff\xff\xff\xff'
+			b'TIT2\x00\x00\x00\x07\x00\x00\x03Intro\x00'
+		)
+
+		frame = ID3Frame.from_byte_array(byte_array)
+		frame.sub_frames[0].text = 'Outro'
+		self.assertTrue(frame.dirty)
+		self.assertEqual('Outro', ID3Frame.from_byte_array(frame.serialize()).title)
+		self.assertFalse(frame.dirty)
+
+		frame = ID3Frame.from_byte_array(byte_array)
+		frame.sub_frames.append(ID3TextFrame.from_scratch('TPE1', 'The Offspring'))
+		self.assertTrue(frame.dirty)
+		self.assertEqual(['TIT2', 'TPE1'], [f.name for f in ID3Frame.from_byte_array(frame.serialize()).sub_frames])
+
+	def test_sub_frames_use_string_pool(self):
+		string_pool = ID3StringPool()
+		byte_array = (
+			b'CHAP\x00\x00\x00\x25\x00\x00chp\x00\x00\x00\x00\x00\x00\x00\x13\x88\xff\xff\xff\xff\xff\xff\xff\xff'
+			b'TIT2\x00\x00\x00\x07\x00\x00\x03Intro\x00'
+		)
+
+		ID3Frame.from_byte_array(byte_array, string_pool=string_pool)
+		ID3Frame.from_byte_array(byte_array, string_pool=string_pool)
+
+		self.assertEqual(1, string_pool.hits)
+
+	def test_nested_chapters_are_rejected(self):
+		byte_array = b'TIT2\x00\x00\x00\x07\x00\x00\x03Intro\x00'
+		for _ in range(2000):
+			body = b'chp\x00' + b'\x00' * 16 + byte_array
+			byte_array = b'CHAP' + pack_int(len(body), base=SYNCHSAFE_BASE, min_bytes=4) + b'\x00\x00' + body
+
+		tag = b'ID3\x04\x00\x00' + pack_int(len(byte_array), base=SYNCHSAFE_BASE, min_bytes=4) + byte_array
+
+		with self.assertRaises(ID3IllegalFormatError):
+			ID3.from_byte_array(tag, limits=ID3Limits(max_frames=10))
+
+	def test_sub_frames_are_limited(self):
+		body = b'chp\x00' + b'\x00' * 16 + b'TIT2\x00\x00\x00\x07\x00\x00\x03Intro\x00' * 3
+		byte_array = b'CHAP' + pack_int(len(body), base=SYNCHSAFE_BASE, min_bytes=4) + b'\x00\x00' + body
+
+		with self.assertRaises(ID3LimitExceededError):
+			ID3Frame.from_byte_array(byte_array, limits=ID3Limits(max_frames=2))
+
+
 class TestID3PictureFrame(unittest.TestCase):
 
 	def test_serialization(self):
@@ -387,6 +1479,169 @@ class TestID3PictureFrame(unittest.TestCase):
 		self.assertEqual('A bright coloured fish', frame.description)
 		self.assertEqual(b'....the...picture....', frame.binary_picture)
 
+	def test_picture_is_not_copied_during_serialization(self):
+		binary_picture = b'....the...picture....'
+		frame = ID3PictureFrame.from_scratch('image/jpeg', ID3PictureTypes.FRONT_COVER, '', binary_picture)
+
+		self.assertIs(binary_picture, frame.serialize_buffers()[-1])
+
+
+class TestStreamedPictures(unittest.TestCase):
+
+	binary_picture = bytes(range(256)) * 1000
+
+	def test_write_picture_from_file(self):
+		picture_path = self.make_file(TestStreamedPictures.binary_picture)
+		mp3_path = self.make_file(b'\xff\xf0...the.mp3.file...')
+
+		id3 = ID3.from_file(mp3_path)
+		id3.add_frame(ID3PictureFrame.from_picture_file('image/png', ID3PictureTypes.FRONT_COVER, 'Cover', picture_path))
+		id3.to_file()
+
+		self.verify_picture(mp3_path)
+
+	def test_write_picture_from_stream_in_place(self):
+		id3 = ID3.from_scratch()
+		mp3_path = self.make_file(id3.serialize(min_length=300000) + b'\xff\xf0...the.mp3.file...')
+
+		with open(self.make_file(TestStreamedPictures.binary_picture), 'rb') as picture_stream:
+			id3 = ID3.from_file(mp3_path)
+			id3.add_frame(ID3PictureFrame.from_picture_file('image/png', ID3PictureTypes.FRONT_COVER, 'Cover', picture_stream))
+			id3.to_file()
+
+		self.verify_picture(mp3_path)
+		self.assertEqual(300000 - TAG_HEADER_SIZE, ID3.from_file(mp3_path).header.tag_size)
+
+	def test_read_picture_from_file(self):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'The Offspring'))
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, 'Cover' * 500, TestStreamedPictures.binary_picture))
+		mp3_path = self.make_file(id3.serialize())
+
+		frames = list(ID3PictureFrame.iter_from_file(mp3_path))
+
+		self.assertEqual(1, len(frames))
+		self.assertEqual('Cover' * 500, frames[0].description)
+		self.assertIsInstance(frames[0].binary_picture, ID3PictureSource)
+
+		picture_path = tempfile.mkstemp()[1]
+		frames[0].extract_picture(picture_path)
+
+		with open(picture_path, 'rb') as f:
+			self.assertEqual(TestStreamedPictures.binary_picture, f.read())
+
+	def test_write_picture_from_same_file_in_place(self):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'A'))
+		id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, 'Cover', TestStreamedPictures.binary_picture))
+		mp3_path = self.make_file(id3.serialize(min_length=400000) + b'\xff\xf0...the.mp3.file...')
+
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TPE1', 'A' * 100))
+		id3.add_frame(next(ID3PictureFrame.iter_from_file(mp3_path)))
+		id3.to_file(mp3_path)
+
+		self.verify_picture(mp3_path)
+		self.assertEqual('A' * 100, ID3.from_file(mp3_path).find_frame_by_name('TPE1').text)
+		self.assertEqual(400000 - TAG_HEADER_SIZE, ID3.from_file(mp3_path).header.tag_size)
+
+	def test_move_file_range(self):
+		for source, destination in ((2, 7), (7, 2)):
+			path = self.make_file(b'0123456789abcdefghij')
+
+			with open(path, 'r+b', buffering=0) as f:
+				move_file_range(f, source, destination, 10, chunk_size=3)
+				f.seek(destination)
+				self.assertEqual(b'0123456789abcdefghij'[source:source + 10], f.read(10))
+
+	def verify_picture(self, mp3_path):
+		id3 = ID3.from_file(mp3_path)
+		self.assertEqual(TestStreamedPictures.binary_picture, id3.find_frame_by_name('APIC').binary_picture)
+
+		with open(mp3_path, 'rb') as f:
+			self.assertEqual(b'\xff\xf0...the.mp3.file...', f.read()[-20:])
+
+	def make_file(self, byte_array):
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(byte_array)
+
+		return path
+
+class TestID3ArtworkStore(unittest.TestCase):
+
+	def test_pictures_are_stored_once(self):
+		directory = tempfile.mkdtemp()
+		store = ID3ArtworkStore(directory)
+
+		paths = [
+			self.make_mp3('Americana', b'...front...'),
+			self.make_mp3('Americana', b'...front...'),
+			self.make_mp3('Americana', b'...front...', b'...back...'),
+			self.make_mp3('Smash', b'...front...')
+		]
+		store.scan(paths)
+
+		self.assertEqual(2, len(os.listdir(directory)))
+		self.assertEqual(2, len(store.refcounts))
+		self.assertEqual(4 * 11 + 10, store.size)
+		self.assertEqual(11 + 10, store.unique_size)
+
+		digest = store.references[paths[0]][0]
+		self.assertEqual(4, store.refcounts[digest])
+		with open(store.get_picture_path(digest), 'rb') as f:
+			self.assertEqual(b'...front...', f.read())
+
+		report = store.album_report()
+		self.assertEqual(ID3AlbumArtwork(3, 4, 2, 3 * 11 + 10, 11 + 10), report['Americana'])
+		self.assertEqual(ID3AlbumArtwork(1, 1, 1, 11, 11), report['Smash'])
+
+	def test_release_removes_unreferenced_picture(self):
+		directory = tempfile.mkdtemp()
+		store = ID3ArtworkStore(directory)
+
+		frame = ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', b'...front...')
+		digest = store.add_frame(frame, '01.mp3', 'Americana')
+		store.add_frame(frame, '02.mp3', 'Americana')
+
+		store.release(digest, '01.mp3')
+
+		self.assertEqual([digest], os.listdir(directory))
+		self.assertEqual(['02.mp3'], list(store.references))
+		self.assertEqual([('02.mp3', digest)], store.albums['Americana'])
+
+		store.release(digest, '02.mp3')
+
+		self.assertEqual([], os.listdir(directory))
+		self.assertEqual({}, store.references)
+		self.assertEqual({}, store.albums)
+		self.assertEqual(0, store.size)
+
+	def test_duplicate_pictures_are_only_hashed(self):
+		directory = tempfile.mkdtemp()
+		store = ID3ArtworkStore(directory)
+
+		streams = [CountingStream(b'...front...'), CountingStream(b'...front...')]
+		for stream in streams:
+			picture = ID3PictureSource(None, stream, 0, 11)
+			store.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', picture))
+
+		# A new picture is read once to be hashed and once to be written, a duplicate only to be hashed.
+		self.assertEqual([2, 1], [stream.reads for stream in streams])
+		self.assertEqual(1, len(os.listdir(directory)))
+
+	def make_mp3(self, album, *binary_pictures):
+		id3 = ID3.from_scratch()
+		id3.add_frame(ID3TextFrame.from_scratch('TALB', album))
+
+		for binary_picture in binary_pictures:
+			id3.add_frame(ID3PictureFrame.from_scratch('image/png', ID3PictureTypes.FRONT_COVER, '', binary_picture))
+
+		path = tempfile.mkstemp()[1]
+		with open(path, 'wb') as f:
+			f.write(id3.serialize() + b'\xff\xf0...the.mp3.file...')
+
+		return path
 
 class TestID3UnknownFrame(unittest.TestCase):
 
@@ -481,8 +1736,64 @@ class TestTerminatedStrings(unittest.TestCase):
 			terminated_string = 'The quick brown fox jumps over the lazy dog'.encode('utf-16')
 			extract_terminated_string(terminated_string, b'\x00\x00')
 
+	def test_find_terminated_string_skips_unaligned_terminators(self):
+		terminated_string = b'a\x00\x00b' * 1000 + b'\x00\x00garbage'
+		self.assertEqual((0, 4000), find_terminated_string(terminated_string, b'\x00\x00'))
+
+	def test_find_terminated_string_after_few_unaligned_terminators(self):
+		terminated_string = b'a\x00\x00b' * 3 + b'\x00\x00\x00garbage'
+		self.assertEqual((0, 12), find_terminated_string(terminated_string, b'\x00\x00'))
+		self.assertEqual((0, 12), find_terminated_string(memoryview(terminated_string), b'\x00\x00'))
+
+	def test_find_terminated_string_is_aligned_to_start(self):
+		terminated_string = b'.a\x00\x00\x00b\x00\x00'
+		self.assertEqual((1, 3), find_terminated_string(terminated_string, b'\x00\x00', 1))
+
+	def test_find_terminated_string_with_missing_terminator(self):
+		self.assertIsNone(find_terminated_string(b'a\x00\x00b', b'\x00\x00'))
+
+	def test_find_terminated_string_in_memoryview(self):
+		terminated_string = memoryview(b'\x03Die Toten Hosen\x00')
+		self.assertEqual((1, 16), find_terminated_string(terminated_string, b'\x00', 1))
+
 	def test_extract_terminated_string_with_empty_string(self):
 		terminated_string = b'\x00and some content after the terminator'
 		string = extract_terminated_string(terminated_string, b'\x00')
 
 		self.assertEqual(b'', string)
+
+
+class TestChangedRanges(unittest.TestCase):
+
+	def test_identical_byte_arrays(self):
+		self.assertEqual([], list(find_changed_ranges(b'abcdef' * 100, b'abcdef' * 100, block_size=16)))
+
+	def test_ranges_are_narrowed_to_changed_bytes(self):
+		old_byte_array = b'.' * 100
+		new_byte_array = b'.' * 10 + b'x' + b'.' * 50 + b'yy' + b'.' * 37
+
+		changed_ranges = list(find_changed_ranges(old_byte_array, new_byte_array, block_size=16))
+		self.assertEqual([(10, 11), (61, 63)], changed_ranges)
+
+	def test_changed_range_spanning_blocks(self):
+		old_byte_array = b'.' * 100
+		new_byte_array = b'.' * 14 + b'xxxx' + b'.' * 82
+
+		self.assertEqual([(14, 18)], list(find_changed_ranges(old_byte_array, new_byte_array, block_size=16)))
+
+	def test_old_byte_array_is_shorter(self):
+		self.assertEqual([(3, 8)], list(find_changed_ranges(b'abcde', b'abcxxxyz', block_size=4)))
+
+
+class TestWriteBuffers(unittest.TestCase):
+
+	def test_write_more_buffers_than_fit_into_one_system_call(self):
+		buffers = [bytes([i % 256]) * (i % 7) for i in range(3000)]
+
+		path = tempfile.mkstemp()[1]
+		with open(path, 'r+b') as f:
+			f.write(b'0123456789')
+			write_buffers_at(f, 5, buffers)
+
+		with open(path, 'rb') as f:
+			self.assertEqual(b'01234' + b''.join(buffers), f.read())